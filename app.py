@@ -1,37 +1,88 @@
 import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# 'threaded' serves each request on its own OS thread. 'async' runs the app
+# on gevent: sockets, sleeps and threads are patched into cooperative
+# greenlets, so requests waiting on Open Food Facts or Gemini cost almost
+# nothing and one process holds many more of them. This has to happen
+# before anything else imports socket or threading.
+SERVER_MODE = os.getenv('SERVER_MODE', 'threaded')
+if SERVER_MODE == 'async':
+    from gevent import monkey
+    monkey.patch_all()
+
 import requests
-from flask import Flask, render_template, request, send_file, jsonify
+from flask import (Flask, render_template, request, send_file, jsonify,
+                   make_response, url_for, g)
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.security import safe_join
+import click
+from flask_sock import Sock
 import json
-from fpdf import FPDF
 import tempfile
 import logging
 from urllib.parse import urlparse
 import os.path
 import re
-import google.generativeai as genai
-from dotenv import load_dotenv
-import pytesseract
 from PIL import Image, ImageEnhance
 import io
+import sys
 import base64
-from pyzbar.pyzbar import decode
+import contextvars
+import bisect
+import csv
 import traceback
-import cv2
-import numpy as np
-import pillow_heif
-
-# Load environment variables from .env file
-load_dotenv()
+import time
+import threading
+import functools
+import gzip
+import hashlib
+import importlib
+import heapq
+import itertools
+import math
+import random
+import mimetypes
+import sqlite3
+import unicodedata
+import uuid
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import (ThreadPoolExecutor, Future, FIRST_COMPLETED,
+                                as_completed, wait)
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+# OpenCV, Tesseract, zbar, HEIF, FPDF and the Gemini SDK are imported where
+# they are used rather than here: together they are most of the start-up
+# time, and a fresh container should be able to answer before it needs them.
+# warm_up() loads them ahead of the first request that does.
 
 # Set up logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'DEBUG').upper())
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+sock = Sock(app)
 
 # Open Food Facts API URL with English language preference
 API_URL = "https://world.openfoodfacts.org/api/v0/product"
 
+# The only product fields the app reads (page, PDF report, allergy
+# analysis). Open Food Facts is asked for just these, which keeps the
+# multi-hundred-KB full documents off the wire and out of the cache.
+PRODUCT_FIELDS = ('code', 'product_name', 'generic_name', 'image_url',
+                  'ingredients_text', 'ingredients_text_en', 'allergens_tags',
+                  'nutriments')
+
+# JSON and HTML responses at least this large are gzipped for clients
+# that accept it
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+
 # Configure Gemini API
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 if not GEMINI_API_KEY:
@@ -39,18 +90,209 @@ if not GEMINI_API_KEY:
         "GEMINI_API_KEY not found in environment variables. Please check your .env file."
     )
 
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.0-pro-exp-02-05')
-
-
-def check_allergies(ingredients, allergies):
-    try:
-        if not ingredients or ingredients.lower() == 'not available':
-            return "INGREDIENTS NOT AVAILABLE: Unable to perform safety analysis as ingredients information is not available."
-
-        prompt = f"""Analyze these food ingredients for someone with the following allergies/conditions: {allergies}
-
-Ingredients: {ingredients}
+gemini_configure_lock = threading.Lock()
+gemini_configured = False
+
+
+# Import and configure the Gemini SDK on first use.
+def load_genai():
+    global gemini_configured
+    import google.generativeai as genai
+    with gemini_configure_lock:
+        if not gemini_configured:
+            # gRPC does not cooperate with gevent, so async mode talks to
+            # Gemini over REST, which goes through the patched sockets.
+            if SERVER_MODE == 'async':
+                genai.configure(api_key=GEMINI_API_KEY, transport='rest')
+            else:
+                genai.configure(api_key=GEMINI_API_KEY)
+            gemini_configured = True
+    return genai
+
+
+# A Gemini model that is only constructed (and the SDK only imported) when
+# it is first asked for content.
+class GeminiModel:
+
+    def __init__(self, name, system_instruction):
+        self.name = name
+        self.system_instruction = system_instruction
+        self._model = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._model is None:
+                genai = load_genai()
+                self._model = genai.GenerativeModel(
+                    self.name, system_instruction=self.system_instruction)
+        return self._model
+
+    def generate_content(self, *args, **kwargs):
+        return self.load().generate_content(*args, **kwargs)
+
+# Greenlets are cheap, so in async mode the worker pools that mostly wait
+# on upstream I/O are scaled up by this factor.
+POOL_SCALE = int(
+    os.getenv('POOL_SCALE', 16 if SERVER_MODE == 'async' else 1))
+# CPU-bound work (image decoding, OCR, PDF rendering) would stall every
+# greenlet in the process, so in async mode it runs on a small pool of
+# real OS threads instead.
+BLOCKING_THREADS = int(os.getenv('BLOCKING_THREADS', 4))
+
+
+# Run CPU-bound fn off the event loop in async mode; call it directly
+# otherwise.
+def run_blocking(fn, *args, **kwargs):
+    if SERVER_MODE != 'async':
+        return fn(*args, **kwargs)
+    import gevent
+    threadpool = gevent.get_hub().threadpool
+    if threadpool.maxsize != BLOCKING_THREADS:
+        threadpool.maxsize = BLOCKING_THREADS
+    return threadpool.apply(in_context(fn), args, kwargs)
+
+
+# Latency histograms and counters for /metrics. Recording one is a few
+# additions under a lock, cheap enough to do for every stage of every
+# request. Upper bounds of the histogram buckets, in seconds:
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                  30, 60)
+# How often a worker publishes its numbers for the others to report
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 10))
+
+METRIC_DESCRIPTIONS = {
+    'http_request_seconds':
+    ('histogram', 'Time to answer an HTTP request, by endpoint.'),
+    'stage_seconds':
+    ('histogram', 'Time spent in one stage of the scan and report pipeline.'),
+    'stage_errors_total':
+    ('counter', 'Pipeline stages that ended with an exception.'),
+    'barcode_decode_seconds':
+    ('histogram', 'One barcode decode attempt, by preprocessing method.'),
+    'pdf_section_seconds':
+    ('histogram', 'Time to lay out one section of a PDF report.'),
+    'cache_requests_total': ('counter', 'Cache lookups, by cache and result.'),
+}
+
+
+class Metrics:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # (name, labels) -> count, or per-bucket counts followed by the sum
+        self._values = {}
+        self._lock = threading.Lock()
+        self._flushed_at = 0
+        self._process = None
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [0] * (len(self.buckets) +
+                                                       2)
+            histogram[index] += 1
+            histogram[-1] += seconds
+
+    # Time a block, or a whole function when used as a decorator, as one
+    # pipeline stage, and trace it as a span. Exceptions are counted and
+    # passed on.
+    @contextmanager
+    def timed(self, stage, **labels):
+        started = time.perf_counter()
+        try:
+            with trace_span(stage, **labels):
+                yield
+        except Exception:
+            self.inc('stage_errors_total', stage=stage, **labels)
+            raise
+        finally:
+            self.observe('stage_seconds',
+                         time.perf_counter() - started,
+                         stage=stage,
+                         **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[name, labels,
+                     list(value) if isinstance(value, list) else value]
+                    for (name, labels), value in self._values.items()]
+
+    # Each worker process has its own numbers. They are published to the
+    # shared cache now and then (and on every scrape), keyed by process, so
+    # whichever worker answers /metrics reports the sum over all of them.
+    # Entries of exited workers are kept so counters never go backwards.
+    def flush(self, store, force=False):
+        now = time.monotonic()
+        if not force and now - self._flushed_at < METRICS_FLUSH_INTERVAL:
+            return
+        self._flushed_at = now
+        if self._process is None or self._process[0] != os.getpid():
+            self._process = (os.getpid(), uuid.uuid4().hex[:8])
+        store.set(f'{self._process[0]}-{self._process[1]}', self.snapshot())
+
+    def render(self, snapshots):
+        merged = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot:
+                key = (name, tuple(tuple(label) for label in labels))
+                if isinstance(value, list):
+                    total = merged.setdefault(key, [0] * len(value))
+                    for index, amount in enumerate(value):
+                        total[index] += amount
+                else:
+                    merged[key] = merged.get(key, 0) + value
+
+        lines = []
+        described = set()
+        for (name, labels), value in sorted(merged.items()):
+            kind, text = METRIC_DESCRIPTIONS.get(name, ('untyped', name))
+            if name not in described:
+                described.add(name)
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+            if kind != 'histogram':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            bounds = [f'{bound:g}' for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, value[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket'
+                             f'{format_labels(labels + (("le", bound), ))} '
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value[-1]}')
+            lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        f'{name}="{escape_label(value)}"' for name, value in labels)
+    return '{' + pairs + '}'
+
+
+def escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'))
+
+
+metrics = Metrics(METRIC_BUCKETS)
+
+
+# Fixed part of every allergy analysis, sent once as the models' system
+# instruction rather than repeated in each prompt
+ANALYSIS_INSTRUCTIONS = """You analyze food ingredients for someone with the allergies/conditions given in each request.
 
 First, if the ingredients are not in English, translate them to English.
 Then, provide a detailed analysis in this format:
@@ -80,22 +322,2442 @@ IMPORTANT:
 - If you're uncertain about any ingredient's safety, explicitly state "Safety of [ingredient] cannot be determined"
 - DO NOT make assumptions about ingredient safety
 - If ingredients are in a different language, provide both original and translated versions
+- If the ingredient list is marked as truncated, treat the missing part as uncertain
 
 CONCLUSION:
 [SAFE/UNSAFE/CAUTION] - Brief explanation why
 
 Remember, someone's health depends on this analysis. Be thorough and explicit about any uncertainties."""
 
-        response = model.generate_content(prompt)
-        return response.text
+# Asked of the fast model so its answer can be routed
+VERDICT_INSTRUCTIONS = """
+
+Finally, end your answer with exactly these two lines:
+VERDICT: [SAFE/UNSAFE/CAUTION/UNCERTAIN]
+CONFIDENCE: [0-100] - how certain you are that this verdict is correct"""
+
+# Analyses go to the fast model first; only answers it is unsure about are
+# sent on to the pro model. Set GEMINI_FAST_MODEL to empty to always use pro.
+GEMINI_PRO_MODEL = os.getenv('GEMINI_PRO_MODEL', 'gemini-2.0-pro-exp-02-05')
+GEMINI_FAST_MODEL = os.getenv('GEMINI_FAST_MODEL', 'gemini-2.0-flash')
+ESCALATION_CONFIDENCE = int(os.getenv('ESCALATION_CONFIDENCE', 80))
+
+model = GeminiModel(GEMINI_PRO_MODEL, ANALYSIS_INSTRUCTIONS)
+fast_model = (GeminiModel(GEMINI_FAST_MODEL,
+                          ANALYSIS_INSTRUCTIONS + VERDICT_INSTRUCTIONS)
+              if GEMINI_FAST_MODEL else None)
+
+# Barcodes Open Food Facts does not know about are remembered separately from
+# product data, with a shorter lifetime, so repeat scans of unlisted products
+# (store brands especially) do not hit the API every time.
+NEGATIVE_CACHE_TTL = int(os.getenv('NEGATIVE_CACHE_TTL', 6 * 60 * 60))
+NEGATIVE_CACHE_SIZE = int(os.getenv('NEGATIVE_CACHE_SIZE', 10000))
+
+
+# Barcodes Open Food Facts does not list. Kept in the configured cache
+# backend like products, so with the shared tier one worker's miss spares
+# the others from asking again for NEGATIVE_CACHE_TTL.
+class NegativeCache:
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self._misses = make_cache('negative_barcodes', max_size)
+        # When an explicit re-check last found each barcode after all (the
+        # entry's stored time). A miss from a lookup that started before
+        # then is stale and is not kept; one from a later lookup (the
+        # product was delisted again) is.
+        self._rechecks = make_cache('rechecked_barcodes', max_size)
+
+    def is_missing(self, barcode):
+        return self._misses.get(barcode, self.ttl) is not None
+
+    # started_at is the time.time() at which the lookup that missed began
+    def add(self, barcode, started_at):
+        # Stored first and taken back if need be, so that a re-check
+        # finishing meanwhile in another worker either sees the entry and
+        # deletes it, or has already recorded itself for this check to see
+        self._misses.set(barcode, 1)
+        recheck = self._rechecks.get(barcode, self.ttl)
+        if recheck is not None and started_at < time.time() - recheck[1]:
+            self._misses.delete(barcode)
+
+    def discard(self, barcode):
+        self._misses.delete(barcode)
+
+    def resolve(self, barcode):
+        self._rechecks.set(barcode, 1)
+        self._misses.delete(barcode)
+
+
+
+# Product data is served from the cache. Entries older than PRODUCT_CACHE_TTL
+# are still returned straight away while a background refresh runs, up to
+# PRODUCT_MAX_STALENESS, which also bounds what is served during an outage.
+PRODUCT_CACHE_TTL = int(os.getenv('PRODUCT_CACHE_TTL', 24 * 60 * 60))
+PRODUCT_MAX_STALENESS = int(
+    os.getenv('PRODUCT_MAX_STALENESS', 7 * 24 * 60 * 60))
+PRODUCT_CACHE_SIZE = int(os.getenv('PRODUCT_CACHE_SIZE', 5000))
+
+
+# Bounded LRU map that remembers when each value was stored
+class TimedCache:
+
+    def __init__(self, max_size, name=None):
+        self.max_size = max_size
+        self.name = name
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+
+    # Returns (value, age in seconds), or None if nothing usable
+    def get(self, key, max_age):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] > max_age:
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        count_lookup(self.name, entry)
+        if entry is None:
+            return None
+        return entry[0], time.time() - entry[1]
+
+    # (key, value) pairs stored within the last max_age seconds
+    def items(self, max_age):
+        now = time.time()
+        with self._lock:
+            return [(key, value)
+                    for key, (value, stored_at) in self._entries.items()
+                    if now - stored_at <= max_age]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    # The cached value, or compute() stored and returned. Concurrent misses
+    # for a key share one compute() call. None results are not stored.
+    def get_or_compute(self, key, max_age, compute):
+        cached = self.get(key, max_age)
+        if cached:
+            return cached[0]
+        return self.fill(key, max_age, compute)
+
+    # get_or_compute for a caller that has already missed with get()
+    def fill(self, key, max_age, compute):
+        return self._flight.do(key, self._compute, key, compute)
+
+    def _compute(self, key, compute):
+        value = compute()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+
+def count_lookup(cache_name, entry):
+    if cache_name:
+        metrics.inc('cache_requests_total',
+                    cache=cache_name,
+                    result='miss' if entry is None else 'hit')
+
+
+refresh_executor = ThreadPoolExecutor(max_workers=4,
+                                      thread_name_prefix='product-refresh')
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+
+class ProductAPIError(Exception):
+
+    def __init__(self, status_code, text):
+        super().__init__(f'API error: {status_code} - {text}')
+        self.status_code = status_code
+        self.text = text
+
+
+# Collapses concurrent calls that share a key into one call whose result
+# (or exception) is handed to every caller that was waiting on it.
+class SingleFlight:
+
+    class _Call:
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = self._Call()
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+product_flight = SingleFlight()
+
+# Where on-disk caches (translations, profiles, the shared cache tier) live
+CACHE_DIR = os.getenv('CACHE_DIR', os.path.join(tempfile.gettempdir(),
+                                                'allergy-scanner-cache'))
+# 'sqlite' keeps products, unlisted barcodes, analyses and analysis jobs in
+# one SQLite file that every worker process on the node shares, so a result
+# computed by one worker is a hit for all of them. 'memory' keeps them per
+# process.
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'sqlite')
+# A worker computing a shared entry holds a lease on it, renewed while it
+# works. This is how long the lease outlives a worker that died (after
+# which another may take over), and how long a None result stops others
+# from asking again. CACHE_POLL_INTERVAL is how often waiters check.
+CACHE_LEASE_SECONDS = float(os.getenv('CACHE_LEASE_SECONDS', 30))
+CACHE_POLL_INTERVAL = 0.05
+# Entries beyond max_size are trimmed, oldest first, every this many writes
+CACHE_PRUNE_INTERVAL = 100
+
+# Request tracing. Every request gets a correlation id (the caller's
+# X-Request-ID if it sent a usable one), returned in the X-Request-ID
+# header and added to log lines. Its pipeline stages and upstream calls are
+# recorded as spans; TRACE_SAMPLE_RATE of requests, plus every request
+# slower than TRACE_SLOW_SECONDS, are written to TRACE_FILE as JSON lines
+# and can be viewed at /debug/traces/<id>.
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.01))
+TRACE_SLOW_SECONDS = float(os.getenv('TRACE_SLOW_SECONDS', 5))
+TRACE_FILE = os.getenv('TRACE_FILE', os.path.join(CACHE_DIR,
+                                                  'traces.jsonl'))
+# The file is rotated to TRACE_FILE.1 once it grows past this
+TRACE_MAX_BYTES = int(os.getenv('TRACE_MAX_BYTES', 50 * 1024 * 1024))
+# Not worth tracing: the metrics scrape, the trace viewer, static files and
+# the scan websocket, which stays open for a whole session
+TRACE_SKIP_ENDPOINTS = {
+    'static', 'asset', 'prometheus_metrics', 'view_trace', 'scan_session'
+}
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{8,64}$')
+
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class TraceExporter:
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def write(self, spans):
+        data = ''.join(json.dumps(span) + '\n' for span in spans)
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                if (os.path.exists(self.path)
+                        and os.path.getsize(self.path) > self.max_bytes):
+                    os.replace(self.path, self.path + '.1')
+                # Opened per write so that, after one worker rotates the
+                # file, the others follow instead of writing to the old one
+                with open(self.path, 'a', encoding='utf-8') as trace_file:
+                    trace_file.write(data)
+            except OSError as e:
+                logger.warning(f"Could not write traces: {str(e)}")
+
+    def find(self, trace_id):
+        needle = f'"trace_id": "{trace_id}"'
+        spans = []
+        for path in (self.path + '.1', self.path):
+            try:
+                with open(path, encoding='utf-8') as trace_file:
+                    spans.extend(
+                        json.loads(line) for line in trace_file
+                        if needle in line)
+            except FileNotFoundError:
+                continue
+        return spans
+
+
+trace_exporter = TraceExporter(TRACE_FILE, TRACE_MAX_BYTES)
+
+
+# The spans of one request. They are held until the request ends and it is
+# known whether the trace is kept; spans finishing after that (background
+# work the request started) go straight to the exporter, or nowhere.
+class Trace:
+
+    def __init__(self, trace_id, sampled):
+        self.id = trace_id
+        self.sampled = sampled
+        self.kept = None
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            if self.kept is None:
+                self._spans.append(span)
+                return
+        if self.kept:
+            trace_exporter.write([span])
+
+    def close(self, kept):
+        with self._lock:
+            self.kept = kept
+            spans, self._spans = self._spans, []
+        if kept:
+            trace_exporter.write(spans)
+
+
+class Span:
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.name = name
+        self.id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error = None
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._started
+        self.trace.add({
+            'trace_id': self.trace.id,
+            'span_id': self.id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.started_at,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'error': self.error
+        })
+
+
+# Record the enclosed block as a child of the current span. Does nothing
+# outside a traced request.
+@contextmanager
+def trace_span(name, **attributes):
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = Span(parent.trace, name, parent.id,
+                {key: str(value)
+                 for key, value in attributes.items()})
+    token = current_span.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.error = f'{type(e).__name__}: {str(e)}'
+        raise
+    finally:
+        current_span.reset(token)
+        span.finish()
+
+
+# fn bound to the caller's trace context, for work handed to a pool thread,
+# which would otherwise start with none
+def in_context(fn):
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+def add_request_id(record):
+    span = current_span.get()
+    record.request_id = span.trace.id if span else '-'
+    return True
+
+
+for log_handler in logging.getLogger().handlers:
+    log_handler.addFilter(add_request_id)
+    log_handler.setFormatter(
+        logging.Formatter('%(levelname)s:%(name)s:%(request_id)s:%(message)s'))
+
+
+# TimedCache's interface over a table in a SQLite database in WAL mode, so
+# many processes can read while one writes. Values go through encode and
+# decode on the way in and out; a decode that returns None is a miss.
+# get_or_compute is atomic across processes: the first to miss takes a
+# lease row and computes, the others wait for its result.
+class SQLiteCache:
+
+    def __init__(self, path, table, max_size, encode=None, decode=None):
+        self.path = path
+        self.table = table
+        self.max_size = max_size
+        self.encode = encode
+        self.decode = decode
+        self._connection = None
+        self._connection_pid = None
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._writes = 0
+
+    def _connect(self):
+        if self._connection_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path,
+                                         timeout=10,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                'key TEXT PRIMARY KEY, value BLOB, stored_at REAL)')
+            connection.execute(
+                f'CREATE INDEX IF NOT EXISTS {self.table}_stored_at '
+                f'ON {self.table} (stored_at)')
+            connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table}_leases ('
+                'key TEXT PRIMARY KEY, owner TEXT, expires_at REAL)')
+            connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table}_misses ('
+                'key TEXT PRIMARY KEY, stored_at REAL)')
+            connection.commit()
+            self._connection = connection
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def get(self, key, max_age):
+        cached = self._lookup(key, max_age)
+        count_lookup(self.table, cached)
+        return cached
+
+    def _lookup(self, key, max_age):
+        with self._lock:
+            row = self._connect().execute(
+                f'SELECT value, stored_at FROM {self.table} '
+                'WHERE key = ? AND stored_at >= ?',
+                (key, time.time() - max_age)).fetchone()
+        if row is None:
+            return None
+        value = self.decode(row[0]) if self.decode else row[0]
+        if value is None:
+            return None
+        return value, max(0.0, time.time() - row[1])
+
+    def items(self, max_age):
+        with self._lock:
+            rows = self._connect().execute(
+                f'SELECT key, value FROM {self.table} WHERE stored_at >= ?',
+                (time.time() - max_age, )).fetchall()
+        return [(key, self.decode(value) if self.decode else value)
+                for key, value in rows]
+
+    def set(self, key, value):
+        data = self.encode(value) if self.encode else value
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)',
+                (key, data, time.time()))
+            self._writes += 1
+            if self._writes % CACHE_PRUNE_INTERVAL == 0:
+                connection.execute(
+                    f'DELETE FROM {self.table} WHERE key IN ('
+                    f'SELECT key FROM {self.table} '
+                    'ORDER BY stored_at DESC LIMIT -1 OFFSET ?)',
+                    (self.max_size, ))
+            connection.commit()
+
+    def delete(self, key):
+        with self._lock:
+            connection = self._connect()
+            connection.execute(f'DELETE FROM {self.table} WHERE key = ?',
+                               (key, ))
+            connection.commit()
+
+    def get_or_compute(self, key, max_age, compute):
+        cached = self.get(key, max_age)
+        if cached:
+            return cached[0]
+        return self.fill(key, max_age, compute)
+
+    def fill(self, key, max_age, compute):
+        # Threads of this process share one attempt; the lease settles
+        # which process makes it
+        return self._flight.do(key, self._compute, key, max_age, compute)
+
+    def _compute(self, key, max_age, compute):
+        owner = uuid.uuid4().hex
+        while True:
+            cached = self._lookup(key, max_age)
+            if cached:
+                return cached[0]
+            if self._recent_miss(key):
+                return None
+            if self._claim(key, owner):
+                done = threading.Event()
+                threading.Thread(target=self._renew,
+                                 args=(key, owner, done),
+                                 name=f'{self.table}-lease',
+                                 daemon=True).start()
+                try:
+                    value = compute()
+                    if value is None:
+                        self._record_miss(key)
+                    else:
+                        self.set(key, value)
+                    return value
+                finally:
+                    done.set()
+                    self._release(key, owner)
+            time.sleep(CACHE_POLL_INTERVAL)
+
+    # Keep extending the lease while compute() runs, however long it takes
+    # (an analysis can queue and escalate through several Gemini calls). A
+    # process that dies stops renewing, and its lease lapses within
+    # CACHE_LEASE_SECONDS.
+    def _renew(self, key, owner, done):
+        while not done.wait(CACHE_LEASE_SECONDS / 3):
+            with self._lock:
+                connection = self._connect()
+                connection.execute(
+                    f'UPDATE {self.table}_leases SET expires_at = ? '
+                    'WHERE key = ? AND owner = ?',
+                    (time.time() + CACHE_LEASE_SECONDS, key, owner))
+                connection.commit()
+
+    # None results are not cached, but processes waiting on the same key are
+    # told about them rather than each trying again
+    def _record_miss(self, key):
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                f'INSERT OR REPLACE INTO {self.table}_misses VALUES (?, ?)',
+                (key, now))
+            connection.execute(
+                f'DELETE FROM {self.table}_misses WHERE stored_at < ?',
+                (now - CACHE_LEASE_SECONDS, ))
+            connection.commit()
+
+    def _recent_miss(self, key):
+        with self._lock:
+            row = self._connect().execute(
+                f'SELECT 1 FROM {self.table}_misses '
+                'WHERE key = ? AND stored_at >= ?',
+                (key, time.time() - CACHE_LEASE_SECONDS)).fetchone()
+        return row is not None
+
+    def _claim(self, key, owner):
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                f'DELETE FROM {self.table}_leases '
+                'WHERE key = ? AND expires_at < ?', (key, now))
+            cursor = connection.execute(
+                f'INSERT OR IGNORE INTO {self.table}_leases VALUES (?, ?, ?)',
+                (key, owner, now + CACHE_LEASE_SECONDS))
+            connection.commit()
+        return cursor.rowcount == 1
+
+    def _release(self, key, owner):
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                f'DELETE FROM {self.table}_leases '
+                'WHERE key = ? AND owner = ?', (key, owner))
+            connection.commit()
+
+
+# A cache for the configured backend. encode/decode are only used by shared
+# backends, which have to store bytes or text.
+def make_cache(table, max_size, encode=None, decode=None):
+    if CACHE_BACKEND == 'memory':
+        return TimedCache(max_size, table)
+    return SQLiteCache(os.path.join(CACHE_DIR, 'cache.sqlite3'), table,
+                       max_size, encode, decode)
+
+
+product_cache = make_cache('products', PRODUCT_CACHE_SIZE,
+                           lambda record: record.to_bytes(),
+                           lambda data: ProductRecord.from_bytes(data))
+negative_cache = NegativeCache(NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_SIZE)
+
+# Upstream timeouts and circuit breaker settings
+OFF_TIMEOUT = float(os.getenv('OFF_TIMEOUT', 10))
+GEMINI_TIMEOUT = float(os.getenv('GEMINI_TIMEOUT', 60))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', 30))
+# A second Open Food Facts request is sent once the first has taken longer
+# than the recent p95, clamped to these bounds
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', 0.25))
+HEDGE_MAX_DELAY = float(os.getenv('HEDGE_MAX_DELAY', 3))
+# requests' timeout applies to each socket operation, not the whole call, so
+# a hedged lookup also gives up once this much time has passed in total
+OFF_DEADLINE = float(os.getenv('OFF_DEADLINE', OFF_TIMEOUT + HEDGE_MAX_DELAY))
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, name, retry_after):
+        super().__init__(
+            f'{name} is temporarily unavailable. Please try again shortly.')
+        self.retry_after = retry_after
+
+
+# Rolling window of recent call durations
+class LatencyTracker:
+
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * pct / 100))
+        return samples[index]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+# Fails fast once an upstream keeps failing. After reset_timeout a single
+# trial call is let through; its outcome closes or re-opens the breaker.
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.rejected = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == 'closed':
+                return
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if self.state == 'open' and remaining <= 0:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self._trial_running:
+                self._trial_running = True
+                return
+            self.rejected += 1
+            raise CircuitOpenError(self.name, max(1, int(remaining)))
+
+    # Raise CircuitOpenError if a call would be turned away right now,
+    # without counting it or claiming the half-open trial. For callers that
+    # should not queue for a call that cannot go through.
+    def check(self):
+        with self._lock:
+            if self.state == 'closed':
+                return
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if ((self.state == 'open' and remaining > 0)
+                    or (self.state == 'half_open' and self._trial_running)):
+                self.rejected += 1
+                raise CircuitOpenError(self.name, max(1, int(remaining)))
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if (self.state == 'half_open'
+                    or self.failures >= self.failure_threshold):
+                if self.state != 'open':
+                    logger.warning(f"Circuit breaker for {self.name} opened")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def call(self, fn, *args, **kwargs):
+        self._before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'rejected': self.rejected
+            }
+
+
+off_breaker = CircuitBreaker('Open Food Facts', BREAKER_FAILURE_THRESHOLD,
+                             BREAKER_RESET_TIMEOUT)
+gemini_breaker = CircuitBreaker('Allergy analysis', BREAKER_FAILURE_THRESHOLD,
+                                BREAKER_RESET_TIMEOUT)
+off_latency = LatencyTracker()
+gemini_latency = LatencyTracker()
+hedge_stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+hedge_stats_lock = threading.Lock()
+# Open Food Facts and Gemini calls run on separate pools, so Gemini calls
+# piling up during an outage cannot hold up product lookups
+off_executor = ThreadPoolExecutor(max_workers=32 * POOL_SCALE,
+                                  thread_name_prefix='off')
+gemini_executor = ThreadPoolExecutor(max_workers=16 * POOL_SCALE,
+                                     thread_name_prefix='gemini')
+
+
+def hedge_delay():
+    # Until there is enough history, wait the full upper bound
+    p95 = off_latency.percentile(95) if len(off_latency) >= 20 else None
+    if p95 is None:
+        return HEDGE_MAX_DELAY
+    return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, p95))
+
+
+def timed_get(url, params):
+    started = time.monotonic()
+    with trace_span('off_request', url=url) as span:
+        response = requests.get(url, params=params, timeout=OFF_TIMEOUT)
+        if span:
+            span.attributes['status'] = str(response.status_code)
+    off_latency.record(time.monotonic() - started)
+    return response
+
+
+# Idempotent GET that sends a second, identical request if the first is
+# slower than usual, and returns whichever answers first
+def hedged_get(url, params):
+    deadline = time.monotonic() + OFF_DEADLINE
+    primary = off_executor.submit(in_context(timed_get), url, params)
+    done, _ = wait([primary], timeout=hedge_delay())
+    with hedge_stats_lock:
+        hedge_stats['requests'] += 1
+        if not done:
+            hedge_stats['hedged'] += 1
+    if done:
+        return primary.result()
+
+    hedge = off_executor.submit(in_context(timed_get), url, params)
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending,
+                             timeout=max(0, deadline - time.monotonic()),
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            raise requests.exceptions.Timeout(
+                f'No answer from {url} within {OFF_DEADLINE:g}s')
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    with hedge_stats_lock:
+                        hedge_stats['hedge_wins'] += 1
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+@metrics.timed('off_fetch')
+def get_product_response(barcode, full=False):
+    params = {'lc': 'en'}
+    if not full:
+        params['fields'] = ','.join(PRODUCT_FIELDS)
+    response = hedged_get(f"{API_URL}/{barcode}.json", params)
+    # Server errors count against the breaker; anything else is an answer
+    if response.status_code >= 500:
+        raise ProductAPIError(response.status_code, response.text)
+    return response
+
+
+def generate_with_timeout(gemini_model, prompt):
+    started = time.monotonic()
+    # The SDK gives up on its own after GEMINI_TIMEOUT, which frees the
+    # executor thread; the wait below only stops the request waiting on it
+    future = gemini_executor.submit(
+        in_context(gemini_model.generate_content),
+        prompt,
+        request_options={'timeout': GEMINI_TIMEOUT})
+    with metrics.timed('gemini_call', model=gemini_model.name):
+        response = future.result(timeout=GEMINI_TIMEOUT)
+    gemini_latency.record(time.monotonic() - started)
+    return response
+
+
+# Gemini quota. Requests are released at GEMINI_RPM with bursts of up to
+# GEMINI_BURST; at most GEMINI_QUEUE_SIZE wait for a slot before new ones are
+# turned away with 429.
+GEMINI_RPM = float(os.getenv('GEMINI_RPM', 60))
+GEMINI_BURST = int(os.getenv('GEMINI_BURST', 5))
+GEMINI_QUEUE_SIZE = int(os.getenv('GEMINI_QUEUE_SIZE', 50))
+GEMINI_QUEUE_TIMEOUT = float(os.getenv('GEMINI_QUEUE_TIMEOUT', 30))
+GEMINI_CONCURRENCY = int(os.getenv('GEMINI_CONCURRENCY', 4))
+
+# Lower numbers are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_UPLOAD = 1
+PRIORITY_BULK = 2
+
+
+class SchedulerBusyError(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__(
+            'Too many analyses in progress. Please try again shortly.')
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Blocks until a token is available
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.paused_until - now,
+                            (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    def refund(self):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    # Stop handing out tokens for a while, e.g. after Gemini reports that the
+    # quota is exhausted
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+            self.tokens = 0
+
+
+# Runs Gemini calls from a bounded priority queue, paced by a token bucket
+class GeminiScheduler:
+
+    def __init__(self, limiter, max_queue, concurrency):
+        self.limiter = limiter
+        self.max_queue = max_queue
+        self.concurrency = concurrency
+        self.rejected = 0
+        self._queue = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._workers_pid = None
+
+    # Workers are started on first use so each forked server process gets
+    # its own
+    def _ensure_workers(self):
+        if self._workers_pid == os.getpid():
+            return
+        self._workers_pid = os.getpid()
+        for i in range(self.concurrency):
+            threading.Thread(target=self._work,
+                             name=f'gemini-scheduler-{i}',
+                             daemon=True).start()
+
+    def retry_after(self):
+        return max(1, math.ceil(len(self._queue) / self.limiter.rate))
+
+    def submit(self, fn, priority):
+        future = Future()
+        with self._cond:
+            self._ensure_workers()
+            if len(self._queue) >= self.max_queue:
+                self.rejected += 1
+                raise SchedulerBusyError(self.retry_after())
+            heapq.heappush(
+                self._queue,
+                (priority, next(self._sequence), in_context(fn), future))
+            self._cond.notify()
+        return future
+
+    def run(self, fn, priority, timeout):
+        future = self.submit(fn, priority)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                raise SchedulerBusyError(self.retry_after())
+            raise
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+            self.limiter.acquire()
+            with self._cond:
+                if not self._queue:
+                    self.limiter.refund()
+                    continue
+                _, _, fn, future = heapq.heappop(self._queue)
+            if not future.set_running_or_notify_cancel():
+                self.limiter.refund()
+                continue
+            try:
+                future.set_result(fn())
+            except CircuitOpenError as e:
+                # The breaker opened while this call was queued; it never
+                # reached Gemini, so it does not use up quota
+                self.limiter.refund()
+                future.set_exception(e)
+            except Exception as e:
+                # Imported here to keep it off start-up; any call that
+                # reached Gemini has loaded it already
+                from google.api_core import exceptions as google_exceptions
+                if isinstance(e, google_exceptions.ResourceExhausted):
+                    logger.warning("Gemini quota exhausted, pausing requests")
+                    self.limiter.pause(60)
+                future.set_exception(e)
+
+    def snapshot(self):
+        with self._cond:
+            queued = [entry[0] for entry in self._queue]
+        return {
+            'queued': len(queued),
+            'queued_interactive': queued.count(PRIORITY_INTERACTIVE),
+            'queued_upload': queued.count(PRIORITY_UPLOAD),
+            'queued_bulk': queued.count(PRIORITY_BULK),
+            'rejected': self.rejected,
+            'tokens_available': int(self.limiter.tokens)
+        }
+
+
+gemini_scheduler = GeminiScheduler(TokenBucket(GEMINI_RPM, GEMINI_BURST),
+                                   GEMINI_QUEUE_SIZE, GEMINI_CONCURRENCY)
+
+
+def generate_analysis(gemini_model, prompt, priority):
+    # Fail fast instead of waiting in the queue for a quota token only to be
+    # turned away by the breaker
+    gemini_breaker.check()
+    return gemini_scheduler.run(
+        lambda: gemini_breaker.call(generate_with_timeout, gemini_model,
+                                    prompt), priority,
+        GEMINI_QUEUE_TIMEOUT + GEMINI_TIMEOUT)
+
+
+VERDICT_PATTERN = re.compile(
+    r'^\s*VERDICT:\s*\**\s*(SAFE|UNSAFE|CAUTION|UNCERTAIN)\b.*$\n?',
+    re.IGNORECASE | re.MULTILINE)
+CONFIDENCE_PATTERN = re.compile(r'^\s*CONFIDENCE:\s*\**\s*(\d{1,3})\b.*$\n?',
+                                re.IGNORECASE | re.MULTILINE)
+
+
+# Returns (verdict, confidence, report) with the routing lines removed from
+# the report. verdict and confidence are None when the model left them out.
+def parse_verdict(text):
+    verdict_match = VERDICT_PATTERN.search(text)
+    confidence_match = CONFIDENCE_PATTERN.search(text)
+    verdict = verdict_match.group(1).upper() if verdict_match else None
+    confidence = (min(100, int(confidence_match.group(1)))
+                  if confidence_match else None)
+    report = CONFIDENCE_PATTERN.sub('', VERDICT_PATTERN.sub('', text))
+    return verdict, confidence, report.rstrip()
+
+
+class RoutingStats:
+
+    def __init__(self):
+        self.answered_by = {'fast': 0, 'pro': 0}
+        self.escalations = {}
+        self.latency = {'fast': LatencyTracker(), 'pro': LatencyTracker()}
+        self._lock = threading.Lock()
+
+    def record_call(self, tier, seconds):
+        self.latency[tier].record(seconds)
+
+    def record_decision(self, tier, reason=None):
+        with self._lock:
+            self.answered_by[tier] += 1
+            if reason:
+                self.escalations[reason] = self.escalations.get(reason,
+                                                                0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            answered_by = dict(self.answered_by)
+            escalations = dict(self.escalations)
+        return {
+            'escalation_confidence': ESCALATION_CONFIDENCE,
+            'answered_by': answered_by,
+            'escalation_reasons': escalations,
+            'p50_seconds': {
+                tier: tracker.percentile(50)
+                for tier, tracker in self.latency.items()
+            },
+            'p95_seconds': {
+                tier: tracker.percentile(95)
+                for tier, tracker in self.latency.items()
+            }
+        }
+
+
+routing_stats = RoutingStats()
+
+
+def timed_analysis(tier, gemini_model, prompt, priority):
+    started = time.monotonic()
+    # Time in this span before its gemini_call is time queued for quota
+    with trace_span('analysis', tier=tier, priority=priority):
+        response = generate_analysis(gemini_model, prompt, priority)
+    routing_stats.record_call(tier, time.monotonic() - started)
+    return response.text
+
+
+# The SAFETY STATUS line every report starts with, the only verdict in
+# answers from the pro model
+SAFETY_STATUS_PATTERN = re.compile(
+    r'SAFETY STATUS:\s*\**\s*(SAFE|UNSAFE|CAUTION|WARNING)\b', re.IGNORECASE)
+
+
+def status_verdict(report):
+    status_match = SAFETY_STATUS_PATTERN.search(report)
+    return status_match.group(1).upper() if status_match else None
+
+
+# Ask the fast model first and escalate to the pro model only when the fast
+# answer is uncertain, low-confidence or could not be read. Returns
+# (report, verdict, confidence); confidence is None for pro answers.
+def route_analysis(prompt, priority):
+    if fast_model is None:
+        report = timed_analysis('pro', model, prompt, priority)
+        routing_stats.record_decision('pro')
+        return report, status_verdict(report), None
+
+    try:
+        text = timed_analysis('fast', fast_model, prompt, priority)
+        verdict, confidence, report = parse_verdict(text)
+        if verdict is None or confidence is None:
+            reason = 'unparsed'
+        elif verdict == 'UNCERTAIN':
+            reason = 'uncertain'
+        elif confidence < ESCALATION_CONFIDENCE:
+            reason = 'low_confidence'
+        else:
+            reason = None
+    except (SchedulerBusyError, CircuitOpenError):
+        raise
+    except Exception as e:
+        logger.warning(f"Fast model analysis failed: {str(e)}")
+        verdict, confidence, reason = None, None, 'fast_error'
+
+    if reason is None:
+        logger.debug(f"Fast model verdict {verdict} ({confidence}%) accepted")
+        routing_stats.record_decision('fast')
+        return report, verdict, confidence
+
+    logger.debug(f"Escalating to {GEMINI_PRO_MODEL}: {reason} "
+                 f"(verdict={verdict}, confidence={confidence})")
+    report = timed_analysis('pro', model, prompt, priority)
+    routing_stats.record_decision('pro', reason)
+    return report, status_verdict(report), None
+
+
+# Products mostly share the same nutriment names, units and allergen tags,
+# so equal tuples of them are stored once. The table is a bounded LRU: the
+# common combinations stay in it, and rare ones fall out instead of being
+# pinned after their products have left the caches.
+INTERN_TABLE_SIZE = int(os.getenv('INTERN_TABLE_SIZE', 4096))
+interned_tuples = OrderedDict()
+interned_tuples_lock = threading.Lock()
+
+
+def intern_tuple(values):
+    values = tuple(sys.intern(value) for value in values)
+    with interned_tuples_lock:
+        shared = interned_tuples.get(values)
+        if shared is None:
+            shared = interned_tuples[values] = values
+            if len(interned_tuples) > INTERN_TABLE_SIZE:
+                interned_tuples.popitem(last=False)
+        else:
+            interned_tuples.move_to_end(values)
+    return shared
+
+
+# One product as the app keeps it: only the fields the page, the report
+# and the allergy analysis read. Numeric nutriments are packed into a
+# double array with their names and units interned, since the same few
+# dozen names repeat across every product. A cached record takes a small
+# fraction of the memory of the OFF document it came from.
+class ProductRecord:
+    __slots__ = ('code', 'product_name', 'generic_name', 'image_url',
+                 'ingredients_text', 'ingredients_text_en', 'allergens',
+                 'nutrient_names', 'nutrient_units', 'nutrient_values')
+
+    # Bumped whenever the serialized layout changes; older entries are
+    # treated as missing
+    VERSION = 1
+
+    def __init__(self,
+                 code=None,
+                 product_name=None,
+                 generic_name=None,
+                 image_url=None,
+                 ingredients_text=None,
+                 ingredients_text_en=None,
+                 allergens=(),
+                 nutrient_names=(),
+                 nutrient_units=(),
+                 nutrient_values=None):
+        self.code = code
+        self.product_name = product_name
+        self.generic_name = generic_name
+        self.image_url = image_url
+        self.ingredients_text = ingredients_text
+        self.ingredients_text_en = ingredients_text_en
+        self.allergens = intern_tuple(allergens)
+        self.nutrient_names = intern_tuple(nutrient_names)
+        self.nutrient_units = intern_tuple(nutrient_units)
+        self.nutrient_values = (nutrient_values if nutrient_values is not None
+                                else array('d'))
+
+    @classmethod
+    def from_off(cls, product_data):
+        product = product_data.get('product', {})
+        nutriments = product.get('nutriments') or {}
+        names, units, values = [], [], array('d')
+        for name, value in nutriments.items():
+            # bool is an int, but never a nutrient amount
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                names.append(name)
+                units.append(nutriments.get(f'{name}_unit') or '')
+                values.append(value)
+        return cls(code=product_data.get('code') or product.get('code'),
+                   product_name=product.get('product_name'),
+                   generic_name=product.get('generic_name'),
+                   image_url=product.get('image_url'),
+                   ingredients_text=product.get('ingredients_text'),
+                   ingredients_text_en=product.get('ingredients_text_en'),
+                   allergens=product.get('allergens_tags') or (),
+                   nutrient_names=names,
+                   nutrient_units=units,
+                   nutrient_values=values)
+
+    # The ingredient list to analyse, preferring the English one
+    @property
+    def ingredients(self):
+        return (self.ingredients_text_en or self.ingredients_text
+                or 'Not available')
+
+    @property
+    def title(self):
+        return self.product_name or self.generic_name or 'Unknown Product'
+
+    # (name, value, unit) for each numeric nutriment
+    def nutriments(self):
+        return zip(self.nutrient_names, self.nutrient_values,
+                   self.nutrient_units)
+
+    def to_bytes(self):
+        return json.dumps([
+            self.VERSION, self.code, self.product_name, self.generic_name,
+            self.image_url, self.ingredients_text, self.ingredients_text_en,
+            self.allergens, self.nutrient_names, self.nutrient_units,
+            base64.b64encode(self.nutrient_values.tobytes()).decode('ascii')
+        ],
+                          separators=(',', ':')).encode('utf-8')
+
+    # None when data was written by an older layout
+    @classmethod
+    def from_bytes(cls, data):
+        fields = json.loads(data)
+        if fields[0] != cls.VERSION:
+            return None
+        values = array('d')
+        values.frombytes(base64.b64decode(fields[10]))
+        return cls(*fields[1:10], nutrient_values=values)
+
+
+def request_product(barcode, full=False):
+    logger.debug(f"Making API request to {API_URL}/{barcode}.json")
+    response = off_breaker.call(get_product_response, barcode, full)
+
+    logger.debug(f"API Response Status: {response.status_code}")
+    logger.debug(f"API Response: {response.text}")
+
+    if response.status_code != 200:
+        raise ProductAPIError(response.status_code, response.text)
+
+    product_data = response.json()
+    if product_data.get('status') == 0:
+        return None
+    if full:
+        return product_data
+    return ProductRecord.from_off(product_data)
+
+
+# Fetch a product from Open Food Facts and keep the cache in step with it
+# request_product, recording a miss in the negative cache along with when
+# this request started, so a miss that raced a re-check can be told apart
+def request_or_miss(barcode):
+    started_at = time.time()
+    product_data = request_product(barcode)
+    if product_data is None:
+        negative_cache.add(barcode, started_at)
+    return product_data
+
+
+def load_product(barcode):
+    product_data = product_flight.do(barcode, request_or_miss, barcode)
+    if product_data is None:
+        product_cache.delete(barcode)
+    else:
+        product_cache.set(barcode, product_data)
+    return product_data
+
+
+def refresh_product(barcode):
+    try:
+        load_product(barcode)
+        logger.debug(f"Refreshed cached product: {barcode}")
+    except Exception as e:
+        logger.warning(f"Background refresh failed for {barcode}: {str(e)}")
+    finally:
+        with refreshing_lock:
+            refreshing.discard(barcode)
+
+
+def schedule_refresh(barcode):
+    with refreshing_lock:
+        if barcode in refreshing:
+            return
+        refreshing.add(barcode)
+    refresh_executor.submit(in_context(refresh_product), barcode)
+
+
+# The complete Open Food Facts document for full=true requests. Not cached:
+# it is only for callers that need fields the app does not use.
+def fetch_full_product(barcode):
+    return product_flight.do(('full', barcode), request_product, barcode,
+                             True)
+
+
+# What API responses include of a product unless full=true is asked for
+def project_product(record):
+    product = {
+        'product_name': record.product_name,
+        'generic_name': record.generic_name,
+        'image_url': record.image_url,
+        'ingredients_text': record.ingredients_text,
+        'ingredients_text_en': record.ingredients_text_en,
+        'allergens_tags': list(record.allergens)
+    }
+    return {
+        'code': record.code,
+        'status': 1,
+        'product': {
+            field: value
+            for field, value in product.items() if value is not None
+        }
+    }
+
+
+# Look up a product on Open Food Facts. Returns (product_data, age) where age
+# is how many seconds old the data is; product_data is None when the barcode
+# is not listed. Known misses are answered locally unless a re-check is
+# requested, and concurrent lookups of the same barcode share one request.
+@trace_span('product_lookup')
+def fetch_product(barcode, recheck=False):
+    cached = product_cache.get(barcode, PRODUCT_MAX_STALENESS)
+
+    if not recheck:
+        if negative_cache.is_missing(barcode):
+            logger.debug(f"Negative cache hit for barcode: {barcode}")
+            return None, 0
+        if cached:
+            product_data, age = cached
+            if age > PRODUCT_CACHE_TTL:
+                logger.debug(
+                    f"Serving stale product {barcode} ({int(age)}s old)")
+                schedule_refresh(barcode)
+            return product_data, age
+
+    try:
+        if recheck:
+            product_data = load_product(barcode)
+        else:
+            # A first lookup: whichever worker gets here first asks Open
+            # Food Facts, and the others pick up its answer
+            product_data = product_cache.fill(
+                barcode, PRODUCT_MAX_STALENESS,
+                lambda: request_or_miss(barcode))
+    except (ProductAPIError, CircuitOpenError,
+            requests.exceptions.RequestException) as e:
+        if not cached:
+            raise
+        logger.warning(
+            f"Open Food Facts unavailable, serving cached {barcode}: {str(e)}")
+        return cached
+
+    if product_data is not None:
+        if recheck:
+            negative_cache.resolve(barcode)
+        else:
+            negative_cache.discard(barcode)
+    return product_data, 0
+
+
+# Finished analyses, keyed on formulation and allergies
+ANALYSIS_CACHE_TTL = int(os.getenv('ANALYSIS_CACHE_TTL', 7 * 24 * 60 * 60))
+ANALYSIS_CACHE_SIZE = int(os.getenv('ANALYSIS_CACHE_SIZE', 10000))
+analysis_cache = make_cache('analysis_results', ANALYSIS_CACHE_SIZE,
+                            json.dumps, json.loads)
+
+# Ingredient lists longer than this are cut at an ingredient boundary
+INGREDIENTS_MAX_CHARS = int(os.getenv('INGREDIENTS_MAX_CHARS', 3000))
+
+INGREDIENTS_LABEL_PATTERN = re.compile(
+    r'^\s*(ingredients?|ingr[ée]dients?|zutaten|ingredientes|ingredienti)'
+    r'\s*:\s*', re.IGNORECASE)
+# Open Food Facts taxonomy prefixes such as "en:" or "fr:"
+TAXONOMY_PREFIX_PATTERN = re.compile(r'\b[a-z]{2}:(?=\w)')
+
+
+# Split on commas and semicolons that are not inside brackets
+def split_top_level(text):
+    items, depth, current = [], 0, []
+    for char in text:
+        if char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth = max(0, depth - 1)
+        elif char in ',;' and depth == 0:
+            items.append(''.join(current).strip())
+            current = []
+            continue
+        current.append(char)
+    items.append(''.join(current).strip())
+    return [item for item in items if item]
+
+
+# Compact an ingredient list before it goes into a prompt: drop labels,
+# taxonomy prefixes, allergen underscores and repeated entries, and cap length
+def normalize_ingredients_text(text):
+    text = text.replace('_', ' ')
+    text = TAXONOMY_PREFIX_PATTERN.sub('', text)
+    text = INGREDIENTS_LABEL_PATTERN.sub('', text)
+    text = ' '.join(text.split()).strip(' .')
+
+    seen = set()
+    items = []
+    for item in split_top_level(text):
+        key = item.lower()
+        if key not in seen:
+            seen.add(key)
+            items.append(item)
+
+    compacted = ''
+    for index, item in enumerate(items):
+        candidate = f"{compacted}, {item}" if compacted else item
+        if len(candidate) > INGREDIENTS_MAX_CHARS:
+            return (f"{compacted} [list truncated, "
+                    f"{len(items) - index} more ingredients]")
+        compacted = candidate
+    return compacted
+
+
+PERCENTAGE_PATTERN = re.compile(r'[<>]?\s*\d+(?:[.,]\d+)?\s*%')
+
+
+def canonical_ingredient_name(text):
+    # Taxonomy ids such as "en:cocoa-butter" become "cocoa butter"
+    text = TAXONOMY_PREFIX_PATTERN.sub('', text)
+    text = re.sub(r'[_*-]', ' ', text)
+    text = PERCENTAGE_PATTERN.sub(' ', text)
+    text = re.sub(r'\s*:\s*', ': ', text)
+    return ' '.join(text.lower().split()).strip(' .:-')
+
+
+# Parse an ingredient list into a tree of {'name', 'children'} nodes, with
+# sub-ingredients taken from the brackets that follow an ingredient
+def parse_ingredients(text):
+    text = INGREDIENTS_LABEL_PATTERN.sub('', text or '')
+    nodes = []
+    for item in split_top_level(text):
+        depth, name, inner = 0, [], []
+        for char in item:
+            if char in '([{':
+                if depth > 0:
+                    inner.append(char)
+                depth += 1
+            elif char in ')]}':
+                depth = max(0, depth - 1)
+                if depth > 0:
+                    inner.append(char)
+                else:
+                    inner.append(',')
+            elif depth > 0:
+                inner.append(char)
+            else:
+                name.append(char)
+        name = canonical_ingredient_name(''.join(name))
+        children = parse_ingredients(''.join(inner)) if inner else []
+        if name:
+            nodes.append({'name': name, 'children': children})
+        else:
+            # Bracketed text on its own, e.g. a stray "(13%)"
+            nodes.extend(children)
+    return nodes
+
+
+def canonical_formulation(nodes):
+    return ','.join(
+        node['name'] +
+        (f"({canonical_formulation(node['children'])})"
+         if node['children'] else '') for node in nodes)
+
+
+# Stable id for a formulation: the same ingredients in the same order hash
+# the same regardless of casing, spacing, percentages or taxonomy prefixes
+def formulation_hash(text):
+    canonical = canonical_formulation(parse_ingredients(text))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+
+
+# The model gets the allergies as the user wrote them. Keyword matches are
+# left out: they are only a hint for the UI and would bias the verdict.
+def build_analysis_prompt(ingredients, profile):
+    return f"Allergies/conditions: {profile.text}\n\nIngredients: {ingredients}"
+
+
+# Rough count (about four characters per token) that is cheap enough to log
+# for every request
+def estimate_tokens(text):
+    return math.ceil(len(text) / 4)
+
+
+class PromptStats:
+
+    def __init__(self):
+        self.requests = 0
+        self.estimated_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, tokens):
+        with self._lock:
+            self.requests += 1
+            self.estimated_tokens += tokens
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'estimated_input_tokens': self.estimated_tokens,
+                'average_input_tokens':
+                (self.estimated_tokens /
+                 self.requests if self.requests else 0),
+                'instruction_tokens': estimate_tokens(ANALYSIS_INSTRUCTIONS)
+            }
+
+
+prompt_stats = PromptStats()
+
+
+# Translations of non-English ingredient lists are kept on disk so a foreign
+# product is only translated once, whatever allergies it is checked against
+TRANSLATION_INSTRUCTIONS = """Translate the food ingredient list you are given into English.
+Reply with only the translated list. Keep the original order, punctuation, percentages and bracketed sub-ingredients.
+Do not add, remove or comment on ingredients."""
+
+# Common ingredient words, used to guess the language of a list locally
+LANGUAGE_WORDS = {
+    'en': {'sugar', 'salt', 'water', 'milk', 'oil', 'flour', 'wheat', 'and',
+           'powder', 'natural', 'flavour', 'flavor', 'acid', 'starch', 'egg'},
+    'fr': {'sucre', 'sel', 'eau', 'lait', 'huile', 'farine', 'blé', 'et',
+           'poudre', 'naturel', 'arôme', 'acide', 'amidon', 'oeuf', 'de'},
+    'de': {'zucker', 'salz', 'wasser', 'milch', 'öl', 'mehl', 'weizen', 'und',
+           'pulver', 'natürliches', 'aroma', 'säure', 'stärke', 'ei'},
+    'es': {'azúcar', 'sal', 'agua', 'leche', 'aceite', 'harina', 'trigo', 'y',
+           'polvo', 'natural', 'aroma', 'ácido', 'almidón', 'huevo', 'de'},
+    'it': {'zucchero', 'sale', 'acqua', 'latte', 'olio', 'farina', 'grano',
+           'e', 'polvere', 'naturale', 'aroma', 'acido', 'amido', 'uovo', 'di'},
+    'nl': {'suiker', 'zout', 'water', 'melk', 'olie', 'bloem', 'tarwe', 'en',
+           'poeder', 'natuurlijk', 'aroma', 'zuur', 'zetmeel', 'ei', 'van'},
+    'pt': {'açúcar', 'sal', 'água', 'leite', 'óleo', 'farinha', 'trigo', 'e',
+           'pó', 'natural', 'aroma', 'ácido', 'amido', 'ovo', 'de'},
+}
+
+
+# Best guess at the language of an ingredient list: a key of LANGUAGE_WORDS,
+# 'other' for text mostly outside the Latin script, or 'unknown'
+def detect_language(text):
+    letters = [char for char in text if char.isalpha()]
+    if not letters:
+        return 'unknown'
+    latin = sum(1 for char in letters
+                if 'LATIN' in unicodedata.name(char, ''))
+    if latin < len(letters) / 2:
+        return 'other'
+
+    words = re.findall(r'[^\W\d_]+', text.lower())
+    scores = {
+        language: sum(1 for word in words if word in vocabulary)
+        for language, vocabulary in LANGUAGE_WORDS.items()
+    }
+    language, score = max(scores.items(), key=lambda item: item[1])
+    if score == 0:
+        return 'unknown'
+    # Shared words like "natural" or "aroma" should not outvote English
+    if scores['en'] == score:
+        return 'en'
+    return language
+
+
+# Small persistent key/value table in a SQLite file under CACHE_DIR
+class SQLiteStore:
+
+    def __init__(self, path, table):
+        self.path = path
+        self.table = table
+        self._connection = None
+        self._connection_pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path,
+                                               timeout=10,
+                                               check_same_thread=False)
+            # Shared by every worker process on the node
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                'key TEXT PRIMARY KEY, value TEXT, created_at REAL)')
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    def get(self, key):
+        with self._lock:
+            row = self._connect().execute(
+                f'SELECT value FROM {self.table} WHERE key = ?',
+                (key, )).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                f'INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)',
+                (key, value, time.time()))
+            connection.commit()
+
+
+translation_store = SQLiteStore(os.path.join(CACHE_DIR, 'cache.sqlite3'),
+                                'translations')
+translation_flight = SingleFlight()
+translation_model = GeminiModel(GEMINI_FAST_MODEL or GEMINI_PRO_MODEL,
+                                TRANSLATION_INSTRUCTIONS)
+
+
+def translate_ingredients(text_hash, text, priority):
+    translation = generate_analysis(translation_model, text, priority).text
+    translation = translation.strip()
+    if translation:
+        translation_store.set(text_hash, translation)
+    return translation
+
+
+# English version of an ingredient list, translating and storing it on first
+# sight. Falls back to the original text if translation fails, in which case
+# the analysis prompt still asks for a translation.
+def english_ingredients(text, priority=PRIORITY_UPLOAD):
+    language = detect_language(text)
+    if language in ('en', 'unknown'):
+        return text
+
+    text_hash = hashlib.sha256(
+        ' '.join(text.split()).encode('utf-8')).hexdigest()
+    translation = translation_store.get(text_hash)
+    if translation:
+        logger.debug(f"Translation cache hit for {language} ingredients")
+        return translation
+
+    try:
+        translation = translation_flight.do(text_hash, translate_ingredients,
+                                            text_hash, text, priority)
+    except SchedulerBusyError:
+        raise
+    except Exception as e:
+        logger.warning(f"Could not translate {language} ingredients: {str(e)}")
+        return text
+    return translation or text
+
+
+# Canonical allergens and the words that name them, both in what people type
+# as an allergy and in ingredient lists
+ALLERGEN_TERMS = {
+    'milk': ['milk', 'dairy', 'lactose', 'cheese', 'butter', 'cream', 'whey',
+             'casein', 'caseinate', 'yogurt', 'yoghurt', 'ghee', 'lactalbumin'],
+    'egg': ['egg', 'albumin', 'ovalbumin', 'lysozyme', 'mayonnaise'],
+    'peanut': ['peanut', 'groundnut', 'arachis', 'monkey nut'],
+    'tree nut': ['tree nut', 'nut', 'almond', 'hazelnut', 'walnut', 'cashew',
+                 'pecan', 'pistachio', 'macadamia', 'brazil nut', 'praline'],
+    'gluten': ['gluten', 'wheat', 'barley', 'rye', 'oat', 'spelt', 'kamut',
+               'semolina', 'durum', 'malt', 'celiac', 'coeliac'],
+    'soy': ['soy', 'soya', 'soybean', 'edamame', 'tofu'],
+    'fish': ['fish', 'anchovy', 'cod', 'salmon', 'tuna', 'haddock', 'sardine'],
+    'crustacean': ['shellfish', 'crustacean', 'shrimp', 'prawn', 'crab',
+                   'lobster', 'crayfish'],
+    'mollusc': ['shellfish', 'mollusc', 'mollusk', 'mussel', 'oyster',
+                'clam', 'squid', 'scallop', 'octopus'],
+    'sesame': ['sesame', 'tahini'],
+    'mustard': ['mustard'],
+    'celery': ['celery', 'celeriac'],
+    'lupin': ['lupin', 'lupine'],
+    'sulphite': ['sulphite', 'sulfite', 'sulphur dioxide', 'sulfur dioxide',
+                 'metabisulphite', 'metabisulfite'],
+}
+# A term can name more than one allergen ("shellfish")
+ALLERGEN_ALIASES = {}
+for allergen, terms in ALLERGEN_TERMS.items():
+    for term in terms:
+        ALLERGEN_ALIASES.setdefault(term, []).append(allergen)
+ALLERGEN_ALIASES.update({'nuts': ['tree nut'], 'tree nuts': ['tree nut']})
+
+# Ingredient names that contain an allergen word without containing the
+# allergen. Only the leading word is kept, so "peanut butter" still counts
+# as peanut but not as milk.
+NON_ALLERGEN_COMPOUNDS = re.compile(
+    r'\b(cocoa|cacao|shea|mango|peanut|nut|coconut|almond|cashew|soy|soya|'
+    r'oat|rice)\s+(?:butter|milk|cream)s?\b|\bcream\s+of\s+tartar\b',
+    re.IGNORECASE)
+
+
+def term_pattern(terms):
+    alternatives = '|'.join(
+        re.escape(term) for term in sorted(terms, key=len, reverse=True))
+    return re.compile(rf'\b(?:{alternatives})(?:e?s)?\b', re.IGNORECASE)
+
+
+# An allergy list parsed once into canonical allergens plus any other
+# conditions (e.g. "diabetes"), with a matcher for ingredient lists. The
+# text, sent to the model, keeps the user's own terms; the id is derived from
+# it, so the same allergy list always gets the same profile.
+class AllergyProfile:
+
+    def __init__(self, terms, allergens, conditions):
+        self.terms = tuple(sorted(terms))
+        self.allergens = tuple(sorted(allergens))
+        self.conditions = tuple(sorted(conditions))
+        self.text = ', '.join(self.terms)
+        self.hash = hashlib.sha256(self.text.encode('utf-8')).hexdigest()
+        self.id = self.hash[:16]
+        self._matchers = [(allergen, term_pattern(ALLERGEN_TERMS[allergen]))
+                          for allergen in self.allergens]
+
+    @classmethod
+    def parse(cls, allergies):
+        terms, allergens, conditions = set(), set(), set()
+        for term in re.split(r'[,;\n]', allergies or ''):
+            term = ' '.join(term.lower().split()).strip(' .')
+            if not term:
+                continue
+            terms.add(term)
+            singular = re.sub(r'(?<=[a-z])e?s$', '', term)
+            named = (ALLERGEN_ALIASES.get(term)
+                     or ALLERGEN_ALIASES.get(singular))
+            if named:
+                allergens.update(named)
+            else:
+                conditions.add(term)
+        return cls(terms, allergens, conditions)
+
+    # Allergens whose names appear in an ingredient list
+    def matches(self, ingredients):
+        ingredients = NON_ALLERGEN_COMPOUNDS.sub(
+            lambda match: match.group(1) or '', ingredients or '')
+        return [
+            allergen for allergen, pattern in self._matchers
+            if pattern.search(ingredients)
+        ]
+
+    def to_dict(self):
+        return {
+            'profile_id': self.id,
+            'hash': self.hash,
+            'terms': list(self.terms),
+            'allergens': list(self.allergens),
+            'conditions': list(self.conditions)
+        }
+
+
+class ProfileNotFoundError(Exception):
+    pass
+
+
+# Compiled profiles by id, with a memo of raw allergy strings so repeated
+# free-text requests are not parsed again
+class ProfileRegistry:
+
+    def __init__(self, store, max_size=10000):
+        self.store = store
+        self.max_size = max_size
+        self._profiles = OrderedDict()
+        self._by_text = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, mapping, key, value):
+        mapping[key] = value
+        mapping.move_to_end(key)
+        while len(mapping) > self.max_size:
+            mapping.popitem(last=False)
+
+    def compile(self, allergies):
+        with self._lock:
+            profile = self._by_text.get(allergies)
+        if profile is not None:
+            return profile
+
+        profile = AllergyProfile.parse(allergies)
+        with self._lock:
+            known = profile.id in self._profiles
+            self._remember(self._profiles, profile.id, profile)
+            self._remember(self._by_text, allergies, profile)
+        if not known:
+            self.store.set(profile.id, profile.text)
+        return profile
+
+    def get(self, profile_id):
+        with self._lock:
+            profile = self._profiles.get(profile_id)
+        if profile is not None:
+            return profile
+        text = self.store.get(profile_id)
+        if text is None:
+            raise ProfileNotFoundError(f'Unknown allergy profile: {profile_id}')
+        profile = AllergyProfile.parse(text)
+        with self._lock:
+            self._remember(self._profiles, profile.id, profile)
+        return profile
+
+    # The profile for a request: by id when one is given, otherwise compiled
+    # from the free-text allergies. None when neither is present.
+    def resolve(self, profile_id, allergies):
+        if profile_id:
+            return self.get(profile_id)
+        if allergies and allergies.strip():
+            return self.compile(allergies)
+        return None
+
+
+profile_registry = ProfileRegistry(
+    SQLiteStore(os.path.join(CACHE_DIR, 'cache.sqlite3'), 'profiles'))
+
+
+NO_INGREDIENTS_REPORT = "INGREDIENTS NOT AVAILABLE: Unable to perform safety analysis as ingredients information is not available."
+
+
+# The allergy report as text for display. Errors become messages; only a
+# full scheduler is raised, so callers can answer 429.
+# allergies may be a compiled AllergyProfile or a free-text allergy list
+@trace_span('allergy_check')
+def check_allergies(ingredients, allergies, priority=PRIORITY_UPLOAD):
+    try:
+        return assess_allergies(ingredients, allergies, priority)['report']
+    except SchedulerBusyError:
+        raise
+    except CircuitOpenError:
+        logger.warning("Skipping allergy analysis, Gemini circuit is open")
+        return "Allergy analysis is temporarily unavailable. Please try again shortly or consult with a healthcare professional."
     except Exception as e:
         logger.error(f"Error checking allergies with Gemini API: {str(e)}")
         return "Error analyzing ingredients for allergies. Please consult with a healthcare professional."
 
 
+# {'report', 'verdict', 'confidence'} for the ingredients, cached. Errors
+# are raised.
+def assess_allergies(ingredients, allergies, priority=PRIORITY_UPLOAD):
+    no_ingredients = {
+        'report': NO_INGREDIENTS_REPORT,
+        'verdict': None,
+        'confidence': None
+    }
+    if not ingredients or ingredients.lower() == 'not available':
+        return no_ingredients
+
+    profile = (allergies if isinstance(allergies, AllergyProfile) else
+               profile_registry.compile(allergies))
+
+    ingredients = english_ingredients(ingredients, priority)
+    formulation = formulation_hash(ingredients)
+    ingredients = normalize_ingredients_text(ingredients)
+    if not ingredients:
+        return no_ingredients
+
+    # Analyses are keyed on the formulation and profile, so products sharing
+    # a recipe share a result, and identical requests already in flight, in
+    # this worker or another, wait for that analysis instead of sending the
+    # same prompt to Gemini again
+    key = hashlib.sha256(
+        f"{formulation}\0{profile.hash}".encode('utf-8')).hexdigest()
+    return analysis_cache.get_or_compute(
+        key, ANALYSIS_CACHE_TTL,
+        lambda: analyze_ingredients(ingredients, profile, priority))
+
+
+def analyze_ingredients(ingredients, profile, priority):
+    prompt = build_analysis_prompt(ingredients, profile)
+    prompt_tokens = estimate_tokens(prompt)
+    prompt_stats.record(prompt_tokens)
+    logger.debug(f"Analysis prompt is about {prompt_tokens} tokens")
+    report, verdict, confidence = route_analysis(prompt, priority)
+    return {'report': report, 'verdict': verdict, 'confidence': confidence}
+
+
+# Front-end libraries are served from static/vendor so the page works on
+# networks without internet access. `flask --app app build-assets` fetches
+# these pinned copies; until it has run, pages fall back to the CDNs.
+VENDOR_ASSETS = {
+    'vendor/bootstrap/bootstrap.min.css':
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/css/bootstrap.min.css',
+    'vendor/bootstrap/bootstrap.bundle.min.js':
+    'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/js/bootstrap.bundle.min.js',
+    'vendor/quagga/quagga.min.js':
+    'https://cdn.jsdelivr.net/npm/quagga@0.12.1/dist/quagga.min.js',
+    'vendor/fontawesome/css/all.min.css':
+    'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css',
+}
+for font in ('fa-brands-400', 'fa-regular-400', 'fa-solid-900',
+             'fa-v4compatibility'):
+    for extension in ('woff2', 'ttf'):
+        VENDOR_ASSETS[f'vendor/fontawesome/webfonts/{font}.{extension}'] = (
+            'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/'
+            f'webfonts/{font}.{extension}')
+
+# Fingerprinted asset URLs change whenever the file does, so browsers may
+# keep them for a year without asking again.
+ASSET_MAX_AGE = int(os.getenv('ASSET_MAX_AGE', 365 * 24 * 60 * 60))
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.json', '.txt', '.ttf'}
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))
+
+
+# Serves files under static/ at /assets/<fingerprint>/<name>. The
+# fingerprint is a hash of the file's content. Pre-compressed .br/.gz
+# siblings written by build-assets are used when the client accepts them;
+# otherwise text files are gzipped once in memory.
+class StaticAssets:
+
+    def __init__(self, root):
+        self.root = root
+        self._fingerprints = {}
+        self._gzipped = {}
+        self._lock = threading.Lock()
+
+    # The file served for name: its minified sibling if build-assets wrote
+    # an up-to-date one, else the file itself. None when it does not exist.
+    def path(self, name):
+        full_path = safe_join(self.root, name)
+        if full_path is None or not os.path.isfile(full_path):
+            return None
+        base, extension = os.path.splitext(full_path)
+        minified = f'{base}.min{extension}'
+        if (not base.endswith('.min') and os.path.isfile(minified)
+                and os.path.getmtime(minified) >= os.path.getmtime(full_path)):
+            return minified
+        return full_path
+
+    def fingerprint(self, full_path):
+        mtime = os.path.getmtime(full_path)
+        with self._lock:
+            cached = self._fingerprints.get(full_path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+        with open(full_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        with self._lock:
+            self._fingerprints[full_path] = (mtime, digest)
+        return digest
+
+    def url(self, name):
+        full_path = self.path(name)
+        if full_path is None:
+            if name in VENDOR_ASSETS:
+                return VENDOR_ASSETS[name]
+            return url_for('static', filename=name)
+        return f'/assets/{self.fingerprint(full_path)}/{name}'
+
+    def gzipped(self, full_path, digest):
+        with self._lock:
+            cached = self._gzipped.get(full_path)
+            if cached and cached[0] == digest:
+                return cached[1]
+        with open(full_path, 'rb') as f:
+            data = gzip.compress(f.read(), compresslevel=9, mtime=0)
+        with self._lock:
+            self._gzipped[full_path] = (digest, data)
+        return data
+
+    def response(self, fingerprint, name):
+        full_path = self.path(name)
+        if full_path is None:
+            return jsonify({'error': 'Asset not found'}), 404
+        digest = self.fingerprint(full_path)
+        mimetype = (mimetypes.guess_type(name)[0]
+                    or 'application/octet-stream')
+        # A stale fingerprint (an old page, or fonts referenced relative to
+        # their stylesheet) still gets the file, but must revalidate.
+        immutable = fingerprint == digest
+        max_age = ASSET_MAX_AGE if immutable else 0
+
+        body, encoding = full_path, None
+        for candidate, suffix in PRECOMPRESSED:
+            if (request.accept_encodings[candidate]
+                    and os.path.isfile(full_path + suffix)
+                    and os.path.getmtime(full_path + suffix) >=
+                    os.path.getmtime(full_path)):
+                body, encoding = full_path + suffix, candidate
+                break
+        compressible = (os.path.splitext(full_path)[1]
+                        in COMPRESSIBLE_EXTENSIONS)
+        if (encoding is None and compressible
+                and request.accept_encodings['gzip']):
+            body = io.BytesIO(self.gzipped(full_path, digest))
+            encoding = 'gzip'
+
+        response = send_file(body,
+                             mimetype=mimetype,
+                             etag=f'{digest}-{encoding or "identity"}',
+                             max_age=max_age,
+                             conditional=True)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if compressible:
+            response.vary.add('Accept-Encoding')
+        if immutable:
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+
+static_assets = StaticAssets(app.static_folder)
+app.add_template_global(static_assets.url, 'asset_url')
+
+
+@app.route('/assets/<fingerprint>/<path:name>')
+def asset(fingerprint, name):
+    return static_assets.response(fingerprint, name)
+
+
+# Fetch the vendored front-end libraries that are missing, minify the app's
+# own CSS/JS when rcssmin/rjsmin are installed, and write .gz (and .br, with
+# the brotli package) variants of every text asset.
+@app.cli.command('build-assets',
+                 help='Vendor, minify and pre-compress static assets.')
+def build_assets():
+    root = app.static_folder
+    for name, url in VENDOR_ASSETS.items():
+        target = os.path.join(root, name)
+        if os.path.exists(target):
+            continue
+        click.echo(f"Downloading {url}")
+        response = requests.get(url, timeout=60)
+        response.raise_for_status()
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(response.content)
+
+    minifiers = {}
+    try:
+        import rcssmin
+        minifiers['.css'] = rcssmin.cssmin
+    except ImportError:
+        click.echo("rcssmin not installed, CSS left unminified")
+    try:
+        import rjsmin
+        minifiers['.js'] = rjsmin.jsmin
+    except ImportError:
+        click.echo("rjsmin not installed, JavaScript left unminified")
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        click.echo("brotli not installed, writing gzip variants only")
+
+    for directory, _, filenames in os.walk(root):
+        if os.path.relpath(directory, root).startswith('vendor'):
+            continue
+        for filename in filenames:
+            base, extension = os.path.splitext(filename)
+            if extension in minifiers and not base.endswith('.min'):
+                source = os.path.join(directory, filename)
+                with open(source, encoding='utf-8') as f:
+                    minified = minifiers[extension](f.read())
+                with open(os.path.join(directory, f'{base}.min{extension}'),
+                          'w', encoding='utf-8') as f:
+                    f.write(minified)
+
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            if os.path.splitext(filename)[1] not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            source = os.path.join(directory, filename)
+            with open(source, 'rb') as f:
+                data = f.read()
+            with open(source + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(source + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+            click.echo(f"Compressed {os.path.relpath(source, root)}")
+
+
+# Start timing the request and give it its correlation id (and trace)
+@app.before_request
+def start_request():
+    g.request_started = time.perf_counter()
+    request_id = request.headers.get('X-Request-ID', '')
+    if not REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex
+    g.request_id = request_id
+    if request.endpoint in TRACE_SKIP_ENDPOINTS:
+        return
+    rule = request.url_rule.rule if request.url_rule else request.path
+    span = Span(Trace(request_id,
+                      random.random() < TRACE_SAMPLE_RATE),
+                f'{request.method} {rule}', None, {'path': request.path})
+    g.request_span = span
+    g.request_span_token = current_span.set(span)
+
+
+# Registered ahead of compress_response so that it runs after it and the
+# time includes compression
+@app.after_request
+def record_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        metrics.observe('http_request_seconds',
+                        time.perf_counter() - started,
+                        endpoint=request.endpoint or 'unmatched',
+                        method=request.method,
+                        status=response.status_code)
+    metrics.flush(metrics_store)
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    span = g.get('request_span')
+    if span is not None:
+        span.attributes['status'] = str(response.status_code)
+    return response
+
+
+# Runs even when the view raised. Whether the trace is kept is decided
+# here, once its duration is known.
+@app.teardown_request
+def finish_request_trace(error):
+    span = g.pop('request_span', None)
+    if span is None:
+        return
+    if error is not None:
+        span.error = f'{type(error).__name__}: {str(error)}'
+    current_span.reset(g.pop('request_span_token'))
+    span.finish()
+    span.trace.close(span.trace.sampled
+                     or span.duration >= TRACE_SLOW_SECONDS)
+
+
+# Gzip JSON and HTML bodies for clients that accept it. Files (send_file)
+# and streamed responses are left alone; static assets handle their own
+# encoding.
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in ('application/json', 'text/html')):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    # Same content, different bytes: the ETag becomes weak, which still
+    # matches If-None-Match
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# The page itself is small and changes with each deploy, so browsers
+# revalidate it every time and get a 304 when nothing changed.
 @app.route('/')
 def index():
-    return render_template('index.html')
+    response = make_response(render_template('index.html'))
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+# Compile an allergy list once; later requests can send its profile_id
+# instead of the free text
+@app.route('/profiles', methods=['POST'])
+def create_profile():
+    data = request.get_json(silent=True) or {}
+    allergies = data.get('allergies', '')
+    if not allergies.strip():
+        return jsonify({'error': 'No allergies provided'}), 400
+    return jsonify(profile_registry.compile(allergies).to_dict()), 201
+
+
+@app.route('/profiles/<profile_id>')
+def get_profile(profile_id):
+    try:
+        return jsonify(profile_registry.get(profile_id).to_dict())
+    except ProfileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+
+
+@app.route('/status/upstreams')
+def upstream_status():
+    with hedge_stats_lock:
+        hedges = dict(hedge_stats)
+    hedges['hedge_rate'] = (hedges['hedged'] / hedges['requests']
+                            if hedges['requests'] else 0.0)
+    return jsonify({
+        'open_food_facts': {
+            'breaker': off_breaker.snapshot(),
+            'p95_seconds': off_latency.percentile(95),
+            'hedge_delay_seconds': hedge_delay(),
+            'hedging': hedges
+        },
+        'gemini': {
+            'breaker': gemini_breaker.snapshot(),
+            'p95_seconds': gemini_latency.percentile(95),
+            'scheduler': gemini_scheduler.snapshot(),
+            'routing': routing_stats.snapshot(),
+            'prompts': prompt_stats.snapshot()
+        }
+    })
+
+
+# Per-worker metric snapshots, merged on every scrape
+metrics_store = make_cache('metrics', 1000, json.dumps, json.loads)
+METRICS_RETENTION = int(os.getenv('METRICS_RETENTION', 30 * 24 * 60 * 60))
+
+
+# Prometheus text exposition of the stage latencies and cache counters of
+# every worker process
+@app.route('/metrics')
+def prometheus_metrics():
+    metrics.flush(metrics_store, force=True)
+    snapshots = [
+        snapshot for _, snapshot in metrics_store.items(METRICS_RETENTION)
+    ]
+    return metrics.render(snapshots), 200, {
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'
+    }
+
+
+# Spans of a trace in waterfall order (each under its parent, siblings by
+# start time), with offsets from the start of the trace
+def waterfall_rows(spans):
+    span_ids = {span['span_id'] for span in spans}
+    children = {}
+    for span in spans:
+        parent_id = span['parent_id'] if span['parent_id'] in span_ids else None
+        children.setdefault(parent_id, []).append(span)
+    started = min(span['start'] for span in spans)
+    total = max(span['start'] + span['duration'] for span in spans) - started
+
+    rows = []
+
+    def visit(parent_id, depth):
+        for span in sorted(children.get(parent_id, []),
+                           key=lambda span: span['start']):
+            offset = span['start'] - started
+            rows.append({
+                'name': span['name'],
+                'depth': depth,
+                'offset_ms': offset * 1000,
+                'duration_ms': span['duration'] * 1000,
+                'left': offset / total * 100 if total else 0,
+                'width': max(span['duration'] / total * 100 if total else 100,
+                             0.2),
+                'attributes': span['attributes'],
+                'error': span['error']
+            })
+            visit(span['span_id'], depth + 1)
+
+    visit(None, 0)
+    return rows, total
+
+
+@app.route('/debug/traces/<trace_id>')
+def view_trace(trace_id):
+    spans = (trace_exporter.find(trace_id)
+             if REQUEST_ID_PATTERN.match(trace_id) else [])
+    if not spans:
+        return jsonify({
+            'error':
+            'Trace not found. Only sampled and slow requests are kept.'
+        }), 404
+    if request.args.get('format') == 'json':
+        return jsonify({'trace_id': trace_id, 'spans': spans})
+    rows, total = waterfall_rows(spans)
+    return render_template('trace.html',
+                           trace_id=trace_id,
+                           rows=rows,
+                           total_ms=total * 1000)
+
+
+# Background allergy analyses started by /scan_barcode. The scan returns as
+# soon as the product is known and the client polls /analysis/<id>.
+ANALYSIS_JOB_TTL = int(os.getenv('ANALYSIS_JOB_TTL', 60 * 60))
+analysis_jobs = make_cache('analysis_jobs',
+                          int(os.getenv('ANALYSIS_JOB_LIMIT', 1000)),
+                          json.dumps, json.loads)
+# Rendered PDF reports, kept for as long as the job that produced them
+report_cache = make_cache('reports', int(os.getenv('REPORT_CACHE_SIZE', 500)))
+# Longest side, in pixels, of the product image embedded in a report
+REPORT_IMAGE_PIXELS = int(os.getenv('REPORT_IMAGE_PIXELS', 400))
+analysis_executor = ThreadPoolExecutor(max_workers=16 * POOL_SCALE,
+                                       thread_name_prefix='analysis')
+
+
+@trace_span('analysis_job')
+def run_analysis_job(job, product_data, ingredients, profile, priority):
+    try:
+        # The image download for the report overlaps the analysis
+        allergy_analysis, pdf = build_product_report(
+            product_data,
+            lambda: check_allergies(ingredients, profile, priority))
+        report_cache.set(job['id'], pdf)
+
+        job.update({
+            'status': 'done',
+            'allergy_analysis': allergy_analysis,
+            'pdf_url':
+            f"/download_pdf?barcode={job['barcode']}&analysis={job['id']}"
+        })
+    except (CircuitOpenError, SchedulerBusyError) as e:
+        job.update({
+            'status': 'error',
+            'error': str(e),
+            'error_status': 429 if isinstance(e, SchedulerBusyError) else 503,
+            'retry_after': e.retry_after
+        })
+    except Exception as e:
+        logger.error(f"Error in analysis job {job['id']}: {str(e)}",
+                     exc_info=True)
+        job.update({
+            'status': 'error',
+            'error': f'Error analyzing ingredients: {str(e)}'
+        })
+    # Store the finished job where any worker polling for it will see it
+    analysis_jobs.set(job['id'], job)
+
+
+def start_analysis_job(barcode,
+                       product_data,
+                       ingredients,
+                       profile,
+                       wait=False,
+                       priority=PRIORITY_INTERACTIVE):
+    job = {'id': uuid.uuid4().hex, 'barcode': barcode, 'status': 'pending'}
+    analysis_jobs.set(job['id'], job)
+    if wait:
+        run_analysis_job(job, product_data, ingredients, profile, priority)
+    else:
+        analysis_executor.submit(in_context(run_analysis_job), job,
+                                 product_data, ingredients, profile, priority)
+    return job
+
+
+@app.route('/analysis/<job_id>')
+def get_analysis(job_id):
+    cached = analysis_jobs.get(job_id, ANALYSIS_JOB_TTL)
+    if not cached:
+        return jsonify({'error': 'Unknown or expired analysis'}), 404
+    job = cached[0]
+    # A job turned away by the scheduler or an open breaker keeps its 429 or
+    # 503, so pollers back off just like direct callers
+    if job.get('retry_after'):
+        return jsonify(job), job['error_status'], {
+            'Retry-After': str(job['retry_after'])
+        }
+    return jsonify(job), 202 if job['status'] == 'pending' else 200
+
+
+# Limits for one camera scanning session
+SESSION_MAX_CODES = int(os.getenv('SESSION_MAX_CODES', 500))
+session_executor = ThreadPoolExecutor(max_workers=16 * POOL_SCALE,
+                                      thread_name_prefix='scan-session')
+
+
+# A camera scanning session over a WebSocket. The allergy profile is held
+# for the whole session, repeated codes are ignored and results are pushed
+# back as each lookup and analysis completes.
+class ScanSession:
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.profile = None
+        self.seen = OrderedDict()
+        self.closed = False
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        with self._send_lock:
+            if self.closed:
+                return
+            try:
+                self.ws.send(json.dumps(message))
+            except Exception as e:
+                logger.debug(f"Scan session closed while sending: {str(e)}")
+                self.closed = True
+
+    def start(self, profile):
+        self.profile = profile
+        self.seen.clear()
+        self.send({
+            'type': 'session',
+            'profile': profile.to_dict() if profile else None
+        })
+
+    def submit(self, barcode):
+        if barcode in self.seen:
+            self.send({'type': 'duplicate', 'barcode': barcode})
+            return
+        self.seen[barcode] = True
+        while len(self.seen) > SESSION_MAX_CODES:
+            self.seen.popitem(last=False)
+        session_executor.submit(self.process, barcode, self.profile)
+
+    def send_error(self, barcode, error, status, retry_after=None):
+        message = {
+            'type': 'error',
+            'barcode': barcode,
+            'error': error,
+            'status': status
+        }
+        if retry_after:
+            message['retry_after'] = retry_after
+        self.send(message)
+        # Let the code be scanned again once a temporary problem has passed
+        if status != 404:
+            self.seen.pop(barcode, None)
+
+    def process(self, barcode, profile):
+        try:
+            product_data, data_age = fetch_product(barcode)
+            if product_data is None:
+                self.send_error(barcode, 'No product found for this barcode',
+                                404)
+                return
+
+            self.send({
+                'type': 'product',
+                'barcode': barcode,
+                'product': project_product(product_data),
+                'pdf_url': f'/download_pdf?barcode={barcode}',
+                'data_age_seconds': int(data_age),
+                'stale': data_age > PRODUCT_CACHE_TTL
+            })
+
+            if profile and not self.closed:
+                ingredients = product_data.ingredients.replace(
+                    '_', ' ').replace('en:', '')
+                self.send({
+                    'type': 'verdict',
+                    'barcode': barcode,
+                    'allergy_analysis': check_allergies(
+                        ingredients, profile, PRIORITY_INTERACTIVE),
+                    'allergen_matches': profile.matches(ingredients)
+                })
+        except (CircuitOpenError, SchedulerBusyError) as e:
+            self.send_error(barcode, str(e), 503, e.retry_after)
+        except Exception as e:
+            logger.error(f"Error in scan session for {barcode}: {str(e)}",
+                         exc_info=True)
+            self.send_error(barcode, f'Error processing barcode: {str(e)}',
+                            500)
+
+
+# Messages from the client are JSON objects:
+#   {"type": "start", "allergies": "..."} or {"type": "start", "profile_id": "..."}
+#   {"type": "code", "barcode": "..."}
+@sock.route('/ws/scan')
+def scan_session(ws):
+    session = ScanSession(ws)
+    try:
+        while True:
+            try:
+                message = json.loads(ws.receive())
+            except (TypeError, ValueError):
+                session.send({'type': 'error', 'error': 'Invalid message'})
+                continue
+
+            if message.get('type') == 'start':
+                try:
+                    session.start(
+                        profile_registry.resolve(message.get('profile_id'),
+                                                 message.get('allergies', '')))
+                except ProfileNotFoundError as e:
+                    session.send({'type': 'error', 'error': str(e)})
+            elif message.get('type') == 'code':
+                barcode = str(message.get('barcode') or '').strip()
+                if barcode:
+                    session.submit(barcode)
+                else:
+                    session.send({
+                        'type': 'error',
+                        'error': 'No barcode provided'
+                    })
+            else:
+                session.send({'type': 'error', 'error': 'Unknown message'})
+    finally:
+        session.closed = True
 
 
 @app.route('/scan_barcode', methods=['POST'])
@@ -109,51 +2771,71 @@ def scan_barcode():
         if not barcode:
             return jsonify({'error': 'No barcode provided'}), 400
 
-        # Call the Open Food Facts API with English language preference
-        logger.debug(f"Making API request to {API_URL}/{barcode}.json")
-        response = requests.get(f"{API_URL}/{barcode}.json",
-                                params={'lc': 'en'})
-
-        logger.debug(f"API Response Status: {response.status_code}")
-        logger.debug(f"API Response: {response.text}")
+        try:
+            profile = profile_registry.resolve(data.get('profile_id'),
+                                               allergies)
+        except ProfileNotFoundError as e:
+            return jsonify({'error': str(e)}), 404
 
-        if response.status_code != 200:
-            error_msg = f'API error: {response.status_code} - {response.text}'
+        # Call the Open Food Facts API with English language preference
+        full = bool(data.get('full'))
+        try:
+            product_data, data_age = fetch_product(
+                barcode, recheck=bool(data.get('recheck')))
+            full_product = (fetch_full_product(barcode)
+                            if full and product_data is not None else None)
+        except ProductAPIError as e:
+            error_msg = str(e)
             logger.error(error_msg)
             return jsonify({'error': error_msg}), 500
+        except CircuitOpenError as e:
+            logger.warning(str(e))
+            return jsonify({'error': str(e)}), 503, {
+                'Retry-After': str(e.retry_after)
+            }
 
-        product_data = response.json()
-
-        if product_data.get('status') == 0:
+        if product_data is None:
             error_msg = 'No product found for this barcode'
             logger.warning(error_msg)
             return jsonify({'error': error_msg}), 404
 
         # Get product information
-        product = product_data.get('product', {})
-        ingredients = product.get('ingredients_text', 'Not available')
-        if ingredients:
-            ingredients = ingredients.replace('_', ' ').replace('en:', '')
-
-        # Check allergies if allergies are provided
-        allergy_analysis = None
-        if allergies:
-            allergy_analysis = check_allergies(ingredients, allergies)
+        ingredients = product_data.ingredients.replace('_', ' ').replace(
+            'en:', '')
 
-        # Create a temporary file for the PDF
-        temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-        temp_pdf.close()
-
-        # Generate PDF with the product information
-        generate_pdf(product_data, temp_pdf.name, allergy_analysis)
-
-        return jsonify({
+        response = {
             'success': True,
             'message': 'Product found',
-            'product': product_data,
-            'allergy_analysis': allergy_analysis,
-            'pdf_url': f'/download_pdf?barcode={barcode}'
-        })
+            'product': full_product or project_product(product_data),
+            'allergy_analysis': None,
+            'pdf_url': f'/download_pdf?barcode={barcode}',
+            'data_age_seconds': int(data_age),
+            'stale': data_age > PRODUCT_CACHE_TTL,
+            'profile_id': profile.id if profile else None,
+            'allergen_matches': profile.matches(ingredients) if profile else []
+        }
+
+        # Check allergies if allergies are provided. The product is returned
+        # straight away and the analysis follows at analysis_url, unless the
+        # client asks to wait for it.
+        if profile:
+            job = start_analysis_job(barcode, product_data, ingredients,
+                                     profile, wait=bool(data.get('wait')))
+            if job.get('retry_after'):
+                logger.warning(job['error'])
+                return jsonify({'error': job['error']}), job[
+                    'error_status'], {
+                        'Retry-After': str(job['retry_after'])
+                    }
+            response['analysis_id'] = job['id']
+            response['analysis_url'] = f"/analysis/{job['id']}"
+            if job['status'] == 'done':
+                response['allergy_analysis'] = job['allergy_analysis']
+                response['pdf_url'] = job['pdf_url']
+            elif job['status'] == 'error':
+                response['allergy_analysis'] = job['error']
+
+        return jsonify(response)
 
     except requests.exceptions.RequestException as e:
         error_msg = f'Network error while calling API: {str(e)}'
@@ -173,10 +2855,12 @@ def download_pdf():
 
         if is_custom:
             # Handle custom analysis PDF download
-            temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            temp_pdf.close()
-
-            return send_file(temp_pdf.name,
+            report_id = request.args.get('report')
+            cached = (report_cache.get(report_id, ANALYSIS_JOB_TTL)
+                      if report_id else None)
+            if not cached:
+                return "Report not found or expired", 404
+            return send_file(io.BytesIO(cached[0]),
                              as_attachment=True,
                              download_name="ingredients_analysis.pdf",
                              mimetype='application/pdf')
@@ -185,23 +2869,29 @@ def download_pdf():
             if not barcode:
                 return "No barcode provided", 400
 
-            response = requests.get(f"{API_URL}/{barcode}.json",
-                                    params={'lc': 'en'})
+            # Report rendered along with a finished analysis
+            job_id = request.args.get('analysis')
+            cached = (report_cache.get(job_id, ANALYSIS_JOB_TTL)
+                      if job_id else None)
+            if cached:
+                return send_file(io.BytesIO(cached[0]),
+                                 as_attachment=True,
+                                 download_name=f"product_{barcode}.pdf",
+                                 mimetype='application/pdf')
 
-            if response.status_code != 200:
-                return f"API error: {response.status_code} - {response.text}", 500
-
-            product_data = response.json()
+            try:
+                product_data, _ = fetch_product(barcode)
+            except ProductAPIError as e:
+                return str(e), 500
+            except CircuitOpenError as e:
+                return str(e), 503, {'Retry-After': str(e.retry_after)}
 
-            if product_data.get('status') == 0:
+            if product_data is None:
                 return "No product found for this barcode", 404
 
-            temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            temp_pdf.close()
-
-            generate_pdf(product_data, temp_pdf.name)
+            _, pdf = build_product_report(product_data)
 
-            return send_file(temp_pdf.name,
+            return send_file(io.BytesIO(pdf),
                              as_attachment=True,
                              download_name=f"product_{barcode}.pdf",
                              mimetype='application/pdf')
@@ -211,7 +2901,10 @@ def download_pdf():
         return f"Error generating PDF: {str(e)}", 500
 
 
-def download_image(url, output_path):
+# Fetch an image into memory. Returns its bytes, or None if it could not be
+# downloaded or is not an image.
+@metrics.timed('image_download')
+def download_image(url):
     try:
         # Add a timeout to the request
         response = requests.get(url, stream=True, timeout=10)
@@ -222,966 +2915,863 @@ def download_image(url, output_path):
         if not content_type.startswith('image/'):
             logger.warning(
                 f"URL {url} is not an image (content-type: {content_type})")
-            return False
+            return None
 
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        data = io.BytesIO()
+        for chunk in response.iter_content(chunk_size=8192):
+            if chunk:
+                data.write(chunk)
 
-        # Verify the file was created and has content
-        if not os.path.exists(output_path) or os.path.getsize(
-                output_path) == 0:
-            logger.warning(
-                f"Downloaded image file is empty or was not created: {output_path}"
-            )
-            return False
+        if data.tell() == 0:
+            logger.warning(f"Downloaded image is empty: {url}")
+            return None
 
-        return True
+        return data.getvalue()
     except requests.exceptions.Timeout:
         logger.error(f"Timeout while downloading image from {url}")
-        return False
+        return None
     except requests.exceptions.RequestException as e:
         logger.error(f"Error downloading image from {url}: {str(e)}")
-        return False
+        return None
     except Exception as e:
         logger.error(f"Unexpected error downloading image: {str(e)}")
-        return False
-
-
-def generate_pdf(product_data, output_path, allergy_analysis=None):
+        return None
+
+
+# Shrink an image to what the report prints (50mm square) and re-encode it
+# as JPEG, so a multi-megapixel product photo doesn't end up in every PDF
+def downsample_image(data):
+    image = Image.open(io.BytesIO(data))
+    # Lets the JPEG decoder skip straight to a reduced scale
+    image.draft('RGB', (REPORT_IMAGE_PIXELS, REPORT_IMAGE_PIXELS))
+    image = image.convert('RGB')
+    image.thumbnail((REPORT_IMAGE_PIXELS, REPORT_IMAGE_PIXELS))
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=80, optimize=True)
+    output.seek(0)
+    return output
+
+
+# The product's image, downloaded and downsampled for the report, as a
+# JPEG in memory. None if the product has no image or it is unusable.
+def download_product_image(product_data):
+    image_url = product_data.image_url
+    if not image_url:
+        return None
+
+    data = download_image(image_url)
+    if data is None:
+        return None
     try:
-        pdf = FPDF()
-        pdf.add_page()
-
-        # Get product information
-        product = product_data.get('product', {})
-
-        # Title first
-        pdf.set_font("Arial", "B", 16)
-        title = product.get('product_name', 'Unknown Product')
-        if not title:
-            title = product.get('generic_name', 'Unknown Product')
-        pdf.cell(0, 10, title, 0, 1, 'C')
-        pdf.ln(5)
-
-        # Download and add product image if available
-        image_url = product.get('image_url')
-        if image_url:
-            try:
-                # Create a temporary file for the image
-                temp_img = tempfile.NamedTemporaryFile(delete=False,
-                                                       suffix='.jpg')
-                temp_img.close()
-
-                # Download the image
-                if download_image(image_url, temp_img.name):
-                    # Add image to PDF with proper sizing and positioning
-                    pdf.image(temp_img.name, x=80, y=25, w=50, h=50)
-                    # Clean up temporary image file
-                    os.unlink(temp_img.name)
-            except Exception as e:
-                logger.error(f"Error adding image to PDF: {str(e)}")
+        return run_blocking(downsample_image, data)
+    except Exception as e:
+        logger.error(f"Could not read product image {image_url}: {str(e)}")
+        return None
 
-        # Move to position after image for content
-        pdf.set_xy(10, 85)  # Start content below the image
 
-        # Ingredients Section
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(0, 10, "Ingredients:", 0, 1)
+# Run a small dependency graph of stages on the shared pipeline executor.
+# stages maps a name to (dependency names, fn); fn receives the results of
+# the stages finished so far. Each stage starts as soon as its dependencies
+# are done, so independent stages overlap. Returns all results by name.
+pipeline_executor = ThreadPoolExecutor(max_workers=32 * POOL_SCALE,
+                                       thread_name_prefix='pipeline')
 
-        # Get ingredients
-        ingredients = product.get('ingredients_text', 'Not available')
-        if ingredients:
-            ingredients = ingredients.replace('_', ' ').replace('en:', '')
-        pdf.set_font("Arial", "", 12)
-        pdf.multi_cell(0, 10, ingredients)
-
-        # Nutrition Facts Section
-        pdf.ln(5)
-        pdf.set_font("Arial", "B", 12)
-        pdf.cell(0, 10, "Nutrition Facts:", 0, 1)
 
-        # Get nutrition facts
-        nutriments = product.get('nutriments', {})
-        if nutriments:
-            pdf.set_font("Arial", "", 12)
-            for key, value in nutriments.items():
-                if isinstance(value, (int, float)):
-                    unit = nutriments.get(f'{key}_unit', '')
-                    pdf.multi_cell(
-                        0, 10,
-                        f"{key.replace('_', ' ').title()}: {value}{unit}")
-
-        # Allergy Analysis Section (if available)
-        if allergy_analysis:
-            pdf.ln(5)
-            pdf.set_font("Arial", "B", 12)
-            pdf.cell(0, 10, "Allergy Analysis:", 0, 1)
-            pdf.set_font("Arial", "", 12)
+def run_pipeline(stages):
+    results = {}
+    running = {}
+    waiting = dict(stages)
+    try:
+        while waiting or running:
+            for name, (dependencies, fn) in list(waiting.items()):
+                if all(dependency in results for dependency in dependencies):
+                    running[pipeline_executor.submit(in_context(fn),
+                                                     dict(results))] = name
+                    del waiting[name]
+            if not running:
+                raise ValueError(
+                    f"Pipeline stages cannot run: {', '.join(waiting)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    finally:
+        for future in running:
+            future.cancel()
+    return results
+
+
+# Render a product report. The product image download and the allergy
+# analysis (when analyze is given) run side by side; the PDF is rendered
+# once both are in. Returns the allergy analysis, if any.
+@trace_span('product_report')
+def build_product_report(product_data, analyze=None):
+    results = run_pipeline({
+        'analysis': ((), lambda _: analyze() if analyze else None),
+        'image': ((), lambda _: download_product_image(product_data)),
+        'pdf': (('analysis', 'image'), lambda done: run_blocking(
+            generate_pdf, product_data, done['analysis'], done['image']))
+    })
+    return results['analysis'], results['pdf']
+
+
+# Render the report into memory and return the PDF's bytes. image is an
+# already downsampled JPEG (see download_product_image). Page streams are
+# compressed, and how long each section took is logged.
+@metrics.timed('pdf_render')
+def generate_pdf(product_data, allergy_analysis=None, image=None):
+    from fpdf import FPDF
+    timings = {}
+    clock = [time.perf_counter()]
+
+    def lap(section):
+        now = time.perf_counter()
+        timings[section] = now - clock[0]
+        metrics.observe('pdf_section_seconds', timings[section],
+                        section=section)
+        clock[0] = now
 
-            # Replace star symbols with text
-            allergy_analysis = allergy_analysis.replace('★', '*').replace('☆', '*')
-
-            # Extract safety status and conclusion
-            safety_status_match = re.search(
-                r'SAFETY STATUS:\s*(SAFE|UNSAFE|WARNING)', allergy_analysis,
-                re.IGNORECASE)
-            conclusion_match = re.search(
-                r'CONCLUSION:\s*(SAFE|UNSAFE|WARNING)\s*-\s*(.*)',
-                allergy_analysis, re.IGNORECASE)
-
-            if safety_status_match:
-                status = safety_status_match.group(1).upper()
-                pdf.set_font("Arial", "B", 12)
-                pdf.cell(0, 10, f"Safety Status: {status}", 0, 1)
-                pdf.set_font("Arial", "", 12)
-
-            # Add the analysis text
-            pdf.multi_cell(0, 10, allergy_analysis)
-
-            if conclusion_match:
-                status = conclusion_match.group(1).upper()
-                explanation = conclusion_match.group(2)
-                pdf.ln(5)
-                pdf.set_font("Arial", "B", 12)
-                pdf.cell(0, 10, f"Final Decision: {status}", 0, 1)
-                pdf.set_font("Arial", "", 12)
-                pdf.multi_cell(0, 10, explanation)
-
-        # Save the PDF
-        pdf.output(output_path)
-        logger.debug(f"PDF generated successfully at {output_path}")
+    try:
+        pdf = FPDF()
+        pdf.set_compression(True)
+        add_product_pages(pdf, product_data, allergy_analysis, image, lap)
+
+        data = bytes(pdf.output())
+        lap('output')
+        logger.info(
+            f"Rendered {len(data)} byte PDF in "
+            f"{sum(timings.values()) * 1000:.1f}ms (" + ', '.join(
+                f"{section} {seconds * 1000:.1f}ms"
+                for section, seconds in timings.items()) + ")")
+        return data
 
     except Exception as e:
         logger.error(f"Error generating PDF: {str(e)}", exc_info=True)
         raise
 
 
-# Create templates directory if it doesn't exist
-if not os.path.exists('templates'):
-    os.makedirs('templates')
-
-# Create the HTML template file
-with open('templates/index.html', 'w') as f:
-    f.write('''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Barcode Scanner</title>
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/css/bootstrap.min.css" rel="stylesheet">
-    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css" rel="stylesheet">
-    <script src="https://cdn.jsdelivr.net/npm/quagga@0.12.1/dist/quagga.min.js"></script>
-    <style>
-        body {
-            background-color: #f8f9fa;
-        }
-        .navbar {
-            background-color: #2c3e50;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }
-        .navbar-brand {
-            color: white !important;
-            font-weight: bold;
-        }
-        #interactive.viewport {
-            position: relative;
-            width: 100%;
-            height: 400px;  /* Increased height */
-            overflow: hidden;
-            border-radius: 10px;
-            box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-            background-color: #000;  /* Dark background */
-        }
-        #interactive.viewport video {
-            width: 100%;
-            height: 100%;
-            object-fit: cover;  /* Ensure video fills container */
-            position: absolute;
-            top: 0;
-            left: 0;
-            border-radius: 10px;
-        }
-        #interactive.viewport canvas {
-            position: absolute;
-            top: 0;
-            left: 0;
-            width: 100%;
-            height: 100%;
-            z-index: 1;
-        }
-        .scanning-feedback {
-            position: absolute;
-            top: 50%;
-            left: 50%;
-            transform: translate(-50%, -50%);
-            width: 280px;
-            height: 180px;
-            border: 2px solid #3498db;
-            border-radius: 10px;
-            z-index: 2;
-            box-shadow: 0 0 0 9999px rgba(0, 0, 0, 0.5);
-        }
-        .scanning-line {
-            position: absolute;
-            width: 100%;
-            height: 2px;
-            background-color: #3498db;
-            animation: scan 2s linear infinite;
-        }
-        @keyframes scan {
-            0% { top: 0; }
-            100% { top: 100%; }
-        }
-        .loading-overlay {
-            position: fixed;
-            top: 0;
-            left: 0;
-            width: 100%;
-            height: 100%;
-            background-color: rgba(0, 0, 0, 0.7);
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            z-index: 9999;
-            color: white;
-            font-size: 1.5rem;
-            display: none;
-        }
-        .product-info {
-            margin-top: 20px;
-            display: none;
-            background: white;
-            border-radius: 10px;
-            box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-        }
-        .card {
-            margin-bottom: 20px;
-            border: none;
-            border-radius: 10px;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }
-        .card-header {
-            background-color: #2c3e50;
-            color: white;
-            border-radius: 10px 10px 0 0 !important;
-        }
-        .allergy-analysis {
-            margin-top: 20px;
-            padding: 15px;
-            border-radius: 10px;
-            background-color: #f8f9fa;
-        }
-        .product-image {
-            max-width: 200px;
-            max-height: 200px;
-            object-fit: contain;
-            border-radius: 10px;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }
-        .btn-primary {
-            background-color: #3498db;
-            border-color: #3498db;
-        }
-        .btn-primary:hover {
-            background-color: #2980b9;
-            border-color: #2980b9;
-        }
-        .btn-success {
-            background-color: #2ecc71;
-            border-color: #2ecc71;
-        }
-        .btn-success:hover {
-            background-color: #27ae60;
-            border-color: #27ae60;
-        }
-        .nav-tabs .nav-link {
-            color: #2c3e50;
-            border: none;
-            padding: 10px 20px;
-            margin-right: 5px;
-            border-radius: 5px 5px 0 0;
-            background-color: #f8f9fa;
-        }
-        .nav-tabs .nav-link.active {
-            background-color: #3498db;
-            color: white;
-        }
-        .nav-tabs .nav-link:not(.active):hover {
-            background-color: #e9ecef;
-        }
-        .form-control {
-            border-radius: 5px;
-            border: 1px solid #ddd;
-        }
-        .form-control:focus {
-            border-color: #3498db;
-            box-shadow: 0 0 0 0.2rem rgba(52, 152, 219, 0.25);
-        }
-        .alert {
-            border-radius: 10px;
-        }
-    </style>
-</head>
-<body>
-    <nav class="navbar navbar-expand-lg navbar-dark mb-4">
-        <div class="container">
-            <a class="navbar-brand" href="#">
-                <i class="fas fa-barcode me-2"></i>
-                Product Scanner
-            </a>
-        </div>
-    </nav>
-
-    <div class="loading-overlay" id="loadingOverlay">
-        <div class="spinner-border text-light" role="status">
-            <span class="visually-hidden">Loading...</span>
-        </div>
-        <span class="ms-2">Processing...</span>
-    </div>
-
-    <div class="container">
-        <div class="row">
-            <div class="col-md-8 mx-auto">
-                <div class="card">
-                    <div class="card-header">
-                        <ul class="nav nav-tabs card-header-tabs" id="scannerTabs" role="tablist">
-                            <li class="nav-item" role="presentation">
-                                <button class="nav-link active" id="camera-tab" data-bs-toggle="tab" data-bs-target="#camera" type="button" role="tab" aria-controls="camera" aria-selected="true">
-                                    <i class="fas fa-camera me-2"></i>Camera Scanner
-                                </button>
-                            </li>
-                            <li class="nav-item" role="presentation">
-                                <button class="nav-link" id="manual-tab" data-bs-toggle="tab" data-bs-target="#manual" type="button" role="tab" aria-controls="manual" aria-selected="false">
-                                    <i class="fas fa-keyboard me-2"></i>Manual Entry
-                                </button>
-                            </li>
-                            <li class="nav-item" role="presentation">
-                                <button class="nav-link" id="upload-tab" data-bs-toggle="tab" data-bs-target="#upload" type="button">
-                                    <i class="fas fa-upload me-2"></i>Upload Images
-                                </button>
-                            </li>
-                        </ul>
-                    </div>
-                    <div class="card-body">
-                        <div class="tab-content" id="scannerTabsContent">
-                            <div class="tab-pane fade show active" id="camera" role="tabpanel" aria-labelledby="camera-tab">
-                                <div class="mb-3">
-                                    <label for="cameraAllergiesInput" class="form-label">Your Allergies (comma-separated)</label>
-                                    <input type="text" class="form-control" id="cameraAllergiesInput" placeholder="e.g., peanuts, dairy, shellfish">
-                                </div>
-                                <div class="text-center mb-3">
-                                    <button class="btn btn-primary" id="startButton">
-                                        <i class="fas fa-play me-2"></i>Start Scanner
-                                    </button>
-                                    <button class="btn btn-danger d-none" id="stopButton">
-                                        <i class="fas fa-stop me-2"></i>Stop Scanner
-                                    </button>
-                                </div>
-                                <div id="interactive" class="viewport"></div>
-                                <div class="alert alert-info mt-3">
-                                    <i class="fas fa-info-circle me-2"></i>
-                                    Position the barcode in front of the camera to scan it.
-                                </div>
-                                <div class="alert alert-warning camera-permission-alert" id="cameraPermissionAlert">
-                                    <i class="fas fa-exclamation-triangle me-2"></i>
-                                    <strong>Camera Permission Required!</strong><br>
-                                    Please follow these steps to enable camera access:<br>
-                                    1. Click the camera icon in your browser's address bar<br>
-                                    2. Select "Allow" for camera access<br>
-                                    3. Refresh the page and try again
-                                </div>
-                                <div class="camera-instructions">
-                                    <strong>Mobile Device Instructions:</strong><br>
-                                    1. Make sure you're using a modern browser (Chrome, Safari, or Firefox)<br>
-                                    2. When prompted, allow camera access<br>
-                                    3. If no prompt appears, look for a camera icon in your browser's address bar<br>
-                                    4. If still having issues, try using the Manual Entry tab instead
-                                </div>
-                            </div>
-                            <div class="tab-pane fade" id="manual" role="tabpanel" aria-labelledby="manual-tab">
-                                <div class="mb-3">
-                                    <label for="allergiesInput" class="form-label">Your Allergies (comma-separated)</label>
-                                    <input type="text" class="form-control" id="allergiesInput" placeholder="e.g., peanuts, dairy, shellfish">
-                                </div>
-                                <div class="mb-3">
-                                    <label for="barcodeInput" class="form-label">Enter Barcode Number</label>
-                                    <input type="text" class="form-control" id="barcodeInput" placeholder="e.g., 0123456789012">
-                                </div>
-                                <button class="btn btn-primary" id="manualSubmit">
-                                    <i class="fas fa-search me-2"></i>Submit
-                                </button>
-                            </div>
-                            <div class="tab-pane fade" id="upload" role="tabpanel" aria-labelledby="upload-tab">
-                                <div class="mb-3">
-                                    <label for="uploadAllergiesInput" class="form-label">Your Allergies (comma-separated)</label>
-                                    <input type="text" class="form-control" id="uploadAllergiesInput" placeholder="e.g., peanuts, dairy, shellfish">
-                                </div>
-
-                                <div class="mb-4">
-                                    <h5>Upload Barcode Image</h5>
-                                    <div class="input-group">
-                                        <input type="file" class="form-control" id="barcodeImageInput" accept="image/jpeg,image/png,image/gif,image/heic">
-                                        <button class="btn btn-primary" id="uploadBarcodeBtn">
-                                            <i class="fas fa-barcode me-2"></i>Process Barcode
-                                        </button>
-                                    </div>
-                                    <small class="text-muted">Supported formats: JPG, PNG, GIF, HEIC</small>
-                                </div>
-
-                                <div class="mb-4">
-                                    <h5>Upload Ingredients Image</h5>
-                                    <div class="input-group">
-                                        <input type="file" class="form-control" id="ingredientsImageInput" accept="image/jpeg,image/png,image/gif,image/heic">
-                                        <button class="btn btn-primary" id="uploadIngredientsBtn">
-                                            <i class="fas fa-list me-2"></i>Process Ingredients
-                                        </button>
-                                    </div>
-                                    <small class="text-muted">Supported formats: JPG, PNG, GIF, HEIC</small>
-                                </div>
-                            </div>
-                        </div>
-                    </div>
-                </div>
-
-                <div class="card product-info" id="productInfo">
-                    <div class="card-header">
-                        <h5 class="card-title mb-0" id="productTitle">Product Information</h5>
-                    </div>
-                    <div class="card-body">
-                        <div class="row">
-                            <div class="col-md-4 text-center mb-3">
-                                <img id="productImage" class="product-image" src="" alt="Product Image" style="display: none;">
-                            </div>
-                            <div class="col-md-8">
-                                <div id="productDetails">
-                                    <!-- Product details will be displayed here -->
-                                </div>
-                            </div>
-                        </div>
-                        <div id="allergyAnalysis" class="allergy-analysis" style="display: none;">
-                            <!-- Allergy analysis will be displayed here -->
-                        </div>
-                        <div class="text-center mt-3">
-                            <a href="#" class="btn btn-success" id="downloadButton">
-                                <i class="fas fa-download me-2"></i>Download PDF
-                            </a>
-                        </div>
-                    </div>
-                </div>
-            </div>
-        </div>
-    </div>
-
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0-alpha1/dist/js/bootstrap.bundle.min.js"></script>
-    <script>
-        document.addEventListener('DOMContentLoaded', function() {
-            const startButton = document.getElementById('startButton');
-            const stopButton = document.getElementById('stopButton');
-            const manualSubmit = document.getElementById('manualSubmit');
-            const barcodeInput = document.getElementById('barcodeInput');
-            const allergiesInput = document.getElementById('allergiesInput');
-            const productInfo = document.getElementById('productInfo');
-            const productTitle = document.getElementById('productTitle');
-            const productDetails = document.getElementById('productDetails');
-            const productImage = document.getElementById('productImage');
-            const allergyAnalysis = document.getElementById('allergyAnalysis');
-            const downloadButton = document.getElementById('downloadButton');
-            const loadingOverlay = document.getElementById('loadingOverlay');
-            const cameraPermissionAlert = document.getElementById('cameraPermissionAlert');
-
-            let downloadUrl = '';
-
-            // Scanner configuration
-            function startScanner() {
-                const viewport = document.getElementById('interactive');
-                viewport.innerHTML = '';
-
-                // Create video element
-                const video = document.createElement('video');
-                video.setAttribute('playsinline', true);
-                video.setAttribute('autoplay', true);
-                video.style.width = '100%';
-                video.style.height = '100%';
-                viewport.appendChild(video);
-
-                // Add scanning feedback overlay
-                const feedback = document.createElement('div');
-                feedback.className = 'scanning-feedback';
-                const scanLine = document.createElement('div');
-                scanLine.className = 'scanning-line';
-                feedback.appendChild(scanLine);
-                viewport.appendChild(feedback);
-
-                let isProcessing = false;
-                let lastDetectedCode = null;
-                let lastDetectionTime = 0;
-                const detectionThreshold = 50; // Reduced to 50ms for faster response
-
-                // Initialize Quagga
-                function initQuagga(stream) {
-                    Quagga.init({
-                        inputStream: {
-                            name: "Live",
-                            type: "LiveStream",
-                            target: video,
-                            constraints: {
-                                width: 1280,
-                                height: 720,
-                                facingMode: "environment",
-                                aspectRatio: 1.777778,
-                                frameRate: 60
-                            },
-                            area: { // Tighter scan area for faster processing
-                                top: "35%",
-                                right: "15%",
-                                left: "15%",
-                                bottom: "35%",
-                            },
-                            singleChannel: true // Faster processing
-                        },
-                        decoder: {
-                            readers: ["ean_reader", "ean_8_reader", "upc_reader", "upc_e_reader"],
-                            multiple: false,
-                            debug: false,
-                            locate: true
-                        },
-                        locate: true,
-                        frequency: 60, // Process every frame
-                        numOfWorkers: 8, // Use more workers
-                        locator: {
-                            patchSize: "medium",
-                            halfSample: false
-                        }
-                    }, function(err) {
-                        if (err) {
-                            console.error('Quagga initialization failed:', err);
-                            return;
-                        }
-                        console.log('Quagga initialization succeeded');
-                        Quagga.start();
-                    });
-
-                    // Handle successful scans
-                    Quagga.onDetected(function(result) {
-                        const currentTime = Date.now();
-                        const code = result.codeResult.code;
-
-                        // Only check time threshold for same code
-                        if (isProcessing ||
-                            (code === lastDetectedCode &&
-                             currentTime - lastDetectionTime < detectionThreshold)) {
-                            return;
-                        }
-
-                        lastDetectedCode = code;
-                        lastDetectionTime = currentTime;
-
-                        // Immediately stop scanning and show processing state
-                        isProcessing = true;
-                        Quagga.stop();
-                        stopScanner();
-
-                        // Show processing overlay
-                        loadingOverlay.style.display = 'flex';
-                        loadingOverlay.innerHTML = `
-                            <div class="text-center">
-                                <div class="spinner-border text-light mb-3" role="status">
-                                    <span class="visually-hidden">Loading...</span>
-                                </div>
-                                <div class="text-light">
-                                    <h4>Barcode Detected!</h4>
-                                    <p>Processing product information...</p>
-                                </div>
-                            </div>
-                        `;
-
-                        console.log('Barcode detected:', code);
-
-                        // Make API call
-                        fetch('/scan_barcode', {
-                            method: 'POST',
-                            headers: {
-                                'Content-Type': 'application/json'
-                            },
-                            body: JSON.stringify({
-                                barcode: code,
-                                allergies: document.getElementById('cameraAllergiesInput').value.trim()
-                            })
-                        })
-                        .then(response => response.json())
-                        .then(data => {
-                            if (data.success) {
-                                handleBarcodeSuccess(data);
-                            } else {
-                                loadingOverlay.style.display = 'none';
-                                alert('Error: ' + (data.error || 'Failed to process barcode'));
-                            }
-                        })
-                        .catch(error => {
-                            console.error('Error with API call:', error);
-                            loadingOverlay.style.display = 'none';
-                            alert('Error processing barcode. Please try again.');
-                        });
-                    });
-
-                    // Minimal overlay drawing for performance
-                    Quagga.onProcessed(function(result) {
-                        if (result && result.codeResult && result.codeResult.code) {
-                            const drawingCtx = Quagga.canvas.ctx.overlay;
-                            const drawingCanvas = Quagga.canvas.dom.overlay;
-                            drawingCtx.clearRect(0, 0, parseInt(drawingCanvas.getAttribute("width")), parseInt(drawingCanvas.getAttribute("height")));
-                            if (result.box) {
-                                Quagga.ImageDebug.drawPath(result.box, { x: 0, y: 1 }, drawingCtx, { color: "#00F", lineWidth: 2 });
-                            }
-                        }
-                    });
-                }
-
-                // Try to start the camera
-                navigator.mediaDevices.getUserMedia({
-                    video: {
-                        facingMode: { ideal: 'environment' },
-                        width: { ideal: 1280 },
-                        height: { ideal: 720 }
-                    }
-                })
-                .then(function(stream) {
-                    video.srcObject = stream;
-                    return video.play();
-                })
-                .then(() => {
-                    initQuagga(video.srcObject);
-                    startButton.classList.add('d-none');
-                    stopButton.classList.remove('d-none');
-                    cameraPermissionAlert.style.display = 'none';
-                })
-                .catch(function(err) {
-                    console.error('Camera error:', err);
-                    displayCameraError(err);
-                });
-            }
-
-            // Improve stop scanner function
-            function stopScanner() {
-                Quagga.stop();
-                const video = document.querySelector('#interactive video');
-                if (video && video.srcObject) {
-                    const tracks = video.srcObject.getTracks();
-                    tracks.forEach(track => track.stop());
-                    video.srcObject = null;
-                }
-                const viewport = document.getElementById('interactive');
-                viewport.innerHTML = '';
-                startButton.classList.remove('d-none');
-                stopButton.classList.add('d-none');
-            }
-
-            function displayCameraError(err) {
-                console.error('Camera error:', err);
-                let errorMessage = 'Camera access error: ';
-
-                if (err.name === 'NotAllowedError' || err.name === 'PermissionDeniedError') {
-                    errorMessage = 'Please allow camera access in your browser settings.';
-                } else if (err.name === 'NotFoundError') {
-                    errorMessage = 'No camera found. Please check your camera connection.';
-                } else if (err.name === 'NotReadableError') {
-                    errorMessage = 'Cannot access camera. Please make sure no other app is using it.';
-                } else {
-                    errorMessage = 'Error accessing camera. Please try again.';
-                }
-
-                cameraPermissionAlert.style.display = 'block';
-                cameraPermissionAlert.innerHTML = `
-                    <i class="fas fa-exclamation-triangle me-2"></i>
-                    <strong>Camera Access Error</strong><br>
-                    ${errorMessage}<br><br>
-                    <strong>Tips:</strong><br>
-                    1. Make sure your camera is working<br>
-                    2. Allow camera access if prompted<br>
-                    3. Try refreshing the page<br>
-                    4. You can also use the Manual Entry or Upload Images options
-                `;
-            }
-
-            function handleBarcodeSuccess(data) {
-                loadingOverlay.style.display = 'none';
-
-                // Show product info section
-                productInfo.style.display = 'block';
-
-                // Store the download URL
-                downloadUrl = data.pdf_url;
-                downloadButton.href = downloadUrl;
-
-                // Display product details
-                const product = data.product.product;
-                productTitle.textContent = product.product_name || 'Product Information';
-
-                // Display product image if available
-                if (product.image_url) {
-                    productImage.src = product.image_url;
-                    productImage.style.display = 'block';
-                } else {
-                    productImage.style.display = 'none';
-                }
-
-                let detailsHTML = '<p><strong>Ingredients:</strong> ' + (product.ingredients_text || 'Not available') + '</p>';
-
-                // Display allergy analysis if available
-                if (data.allergy_analysis) {
-                    displayAllergyAnalysis(data.allergy_analysis);
-                } else {
-                    allergyAnalysis.style.display = 'none';
-                }
-
-                productDetails.innerHTML = detailsHTML;
-
-                // Scroll to the product info
-                productInfo.scrollIntoView({ behavior: 'smooth' });
-            }
-
-            // Start scanner button click handler
-            startButton.addEventListener('click', startScanner);
-
-            // Stop scanner button click handler
-            stopButton.addEventListener('click', stopScanner);
-
-            // Manual barcode submission
-            manualSubmit.addEventListener('click', function() {
-                const barcode = barcodeInput.value.trim();
-                const allergies = allergiesInput.value.trim();
-
-                if (!barcode) {
-                    alert('Please enter a valid barcode');
-                    return;
-                }
-
-                loadingOverlay.style.display = 'flex';
-
-                // Make direct API call
-                fetch('/scan_barcode', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        barcode: barcode,
-                        allergies: allergies
-                    })
-                })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.error) {
-                        throw new Error(data.error);
-                    }
-                    handleBarcodeSuccess(data);
-                })
-                .catch(error => {
-                    console.error('Error:', error);
-                    loadingOverlay.style.display = 'none';
-                    alert('Failed to process barcode: ' + error.message);
-                });
-            });
-
-            // Add new JavaScript for handling uploads
-            const uploadBarcodeBtn = document.getElementById('uploadBarcodeBtn');
-            const uploadIngredientsBtn = document.getElementById('uploadIngredientsBtn');
-            const barcodeImageInput = document.getElementById('barcodeImageInput');
-            const ingredientsImageInput = document.getElementById('ingredientsImageInput');
-            const uploadAllergiesInput = document.getElementById('uploadAllergiesInput');
-
-            uploadBarcodeBtn.addEventListener('click', function() {
-                const file = barcodeImageInput.files[0];
-                const allergies = uploadAllergiesInput.value.trim();
-
-                if (!file) {
-                    alert('Please select a barcode image');
-                    return;
-                }
-
-                const formData = new FormData();
-                formData.append('barcode_image', file);
-                formData.append('allergies', allergies);
-
-                loadingOverlay.style.display = 'flex';
-
-                fetch('/upload_barcode', {
-                    method: 'POST',
-                    body: formData
-                })
-                .then(response => response.json())
-                .then(data => handleResponse(data))
-                .catch(handleError);
-            });
-
-            uploadIngredientsBtn.addEventListener('click', function() {
-                const file = ingredientsImageInput.files[0];
-                const allergies = uploadAllergiesInput.value.trim();
-
-                if (!file) {
-                    alert('Please select an ingredients image');
-                    return;
-                }
-
-                const formData = new FormData();
-                formData.append('ingredients_image', file);
-                formData.append('allergies', allergies);
-
-                loadingOverlay.style.display = 'flex';
-
-                fetch('/upload_ingredients', {
-                    method: 'POST',
-                    body: formData
-                })
-                .then(response => response.json())
-                .then(data => handleResponse(data))
-                .catch(handleError);
-            });
-
-            function handleResponse(data) {
-                loadingOverlay.style.display = 'none';
-
-                if (data.error) {
-                    alert('Error: ' + data.error);
-                    return;
-                }
-
-                // Show product info section
-                productInfo.style.display = 'block';
-
-                if (data.product) {
-                    const product = data.product.product;
-                    productTitle.textContent = product.product_name || 'Product Information';
-
-                    if (product.image_url) {
-                        productImage.src = product.image_url;
-                        productImage.style.display = 'block';
-                    } else {
-                        productImage.style.display = 'none';
-                    }
+# Lay out one product's report (title, image, ingredients, nutrition and
+# analysis) starting on a new page of pdf. lap(section) is called as each
+# section is finished.
+def add_product_pages(pdf,
+                      product_data,
+                      allergy_analysis=None,
+                      image=None,
+                      lap=lambda section: None):
+    pdf.add_page()
+
+    # Title first
+    pdf.set_font("Arial", "B", 16)
+    pdf.cell(0, 10, product_data.title, 0, 1, 'C')
+    pdf.ln(5)
+    lap('title')
+
+    # Add product image if available
+    if image:
+        try:
+            # Add image to PDF with proper sizing and positioning
+            pdf.image(image, x=80, y=25, w=50, h=50)
+        except Exception as e:
+            logger.error(f"Error adding image to PDF: {str(e)}")
+    lap('image')
+
+    # Move to position after image for content
+    pdf.set_xy(10, 85)  # Start content below the image
+
+    # Ingredients Section
+    pdf.set_font("Arial", "B", 12)
+    pdf.cell(0, 10, "Ingredients:", 0, 1)
+
+    # Get ingredients
+    ingredients = product_data.ingredients_text or 'Not available'
+    ingredients = ingredients.replace('_', ' ').replace('en:', '')
+    pdf.set_font("Arial", "", 12)
+    pdf.multi_cell(0, 10, ingredients)
+    lap('ingredients')
+
+    # Nutrition Facts Section
+    pdf.ln(5)
+    pdf.set_font("Arial", "B", 12)
+    pdf.cell(0, 10, "Nutrition Facts:", 0, 1)
+
+    # One row of two plain cells per nutriment; multi_cell would
+    # re-measure and wrap every line
+    if product_data.nutrient_names:
+        pdf.set_font("Arial", "", 11)
+        for key, value, unit in product_data.nutriments():
+            # Values come back from the packed array as floats
+            if value.is_integer():
+                value = int(value)
+            pdf.cell(100, 7, key.replace('_', ' ').title())
+            pdf.cell(0, 7, f"{value}{unit}", 0, 1)
+    lap('nutrition')
+
+    # Allergy Analysis Section (if available)
+    if allergy_analysis:
+        pdf.ln(5)
+        pdf.set_font("Arial", "B", 12)
+        pdf.cell(0, 10, "Allergy Analysis:", 0, 1)
+        pdf.set_font("Arial", "", 12)
 
-                    let detailsHTML = '<p><strong>Ingredients:</strong> ' + (product.ingredients_text || 'Not available') + '</p>';
-                    productDetails.innerHTML = detailsHTML;
-                } else {
-                    productTitle.textContent = 'Ingredients Analysis';
-                    productImage.style.display = 'none';
-                    let detailsHTML = '<p><strong>Extracted Ingredients:</strong> ' + data.ingredients + '</p>';
-                    productDetails.innerHTML = detailsHTML;
-                }
+        # Replace star symbols with text
+        allergy_analysis = allergy_analysis.replace('★', '*').replace('☆', '*')
 
-                // Display allergy analysis
-                if (data.allergy_analysis) {
-                    displayAllergyAnalysis(data.allergy_analysis);
-                }
+        # Extract safety status and conclusion
+        safety_status_match = re.search(
+            r'SAFETY STATUS:\s*(SAFE|UNSAFE|WARNING)', allergy_analysis,
+            re.IGNORECASE)
+        conclusion_match = re.search(
+            r'CONCLUSION:\s*(SAFE|UNSAFE|WARNING)\s*-\s*(.*)',
+            allergy_analysis, re.IGNORECASE)
 
-                // Update download button
-                downloadButton.href = data.pdf_url;
+        if safety_status_match:
+            status = safety_status_match.group(1).upper()
+            pdf.set_font("Arial", "B", 12)
+            pdf.cell(0, 10, f"Safety Status: {status}", 0, 1)
+            pdf.set_font("Arial", "", 12)
 
-                // Scroll to results
-                productInfo.scrollIntoView({ behavior: 'smooth' });
-            }
+        # Add the analysis text
+        pdf.multi_cell(0, 10, allergy_analysis)
 
-            function handleError(error) {
-                console.error('Error:', error);
-                loadingOverlay.style.display = 'none';
-                alert('An error occurred. Please try again.');
-            }
+        if conclusion_match:
+            status = conclusion_match.group(1).upper()
+            explanation = conclusion_match.group(2)
+            pdf.ln(5)
+            pdf.set_font("Arial", "B", 12)
+            pdf.cell(0, 10, f"Final Decision: {status}", 0, 1)
+            pdf.set_font("Arial", "", 12)
+            pdf.multi_cell(0, 10, explanation)
+    lap('analysis')
+
+
+# Bulk exports: one allergy profile checked against a list of barcodes,
+# written as a single PDF with a summary table followed by each product's
+# report. Lookups and analyses run on a thread pool (they are network-bound
+# and share this process's Gemini scheduler at bulk priority).
+EXPORT_MAX_BARCODES = int(os.getenv('EXPORT_MAX_BARCODES', 1000))
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', 8))
+EXPORT_TTL = int(os.getenv('EXPORT_TTL', 24 * 60 * 60))
+# Attempts per product when Gemini or Open Food Facts asks us to back off
+EXPORT_ATTEMPTS = 5
+# A running export that has not finished a product for this long is taken
+# to have died with its worker and may be resumed
+EXPORT_STALL_SECONDS = int(os.getenv('EXPORT_STALL_SECONDS', 15 * 60))
+
+
+# Barcodes from a CSV file: the 'barcode' column if there is a header
+# naming one, otherwise the first column. Duplicates and rows that are not
+# a barcode are skipped.
+def read_barcodes(lines):
+    rows = [row for row in csv.reader(lines) if row]
+    column = 0
+    if rows:
+        header = [cell.strip().lower() for cell in rows[0]]
+        if 'barcode' in header:
+            column = header.index('barcode')
+    barcodes = []
+    for row in rows:
+        value = row[column].strip() if len(row) > column else ''
+        if value.isdigit() and value not in barcodes:
+            barcodes.append(value)
+    return barcodes
+
+
+# Runs the lookups and analyses for an export. Each finished product is
+# appended to a JSON-lines checkpoint, so a run that is interrupted picks
+# up where it stopped; products that failed are tried again.
+class BulkExport:
+
+    def __init__(self,
+                 barcodes,
+                 profile,
+                 checkpoint_path,
+                 workers=EXPORT_WORKERS,
+                 progress=None):
+        self.barcodes = barcodes
+        self.profile = profile
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers
+        self.progress = progress
+        self.results = {}
+        # Products analysed in this run, kept for the report pages
+        self.products = {}
+        self._lock = threading.Lock()
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # A line cut short when the last run died
+                    continue
+                if result.get('status') != 'error':
+                    self.results[result['barcode']] = result
+
+    def _record(self, result):
+        with self._lock:
+            self.results[result['barcode']] = result
+            with open(self.checkpoint_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result) + '\n')
+            done = len(self.results)
+        if self.progress:
+            self.progress(done, len(self.barcodes), result)
+
+    def _analyze(self, barcode):
+        product_data, _ = fetch_product(barcode)
+        if product_data is None:
+            return {'barcode': barcode, 'status': 'not_found'}
+        ingredients = product_data.ingredients.replace('_', ' ').replace(
+            'en:', '')
+        # Raises on Gemini errors, so _process retries them and a failed
+        # product is run again on resume
+        assessment = assess_allergies(ingredients, self.profile,
+                                      PRIORITY_BULK)
+        self.products[barcode] = product_data
+        return {
+            'barcode': barcode,
+            'status': 'ok',
+            'title': product_data.title,
+            'verdict': assessment['verdict'],
+            'confidence': assessment['confidence'],
+            'allergen_matches': self.profile.matches(ingredients),
+            'allergy_analysis': assessment['report']
+        }
 
-            function displayAllergyAnalysis(analysis) {
-                allergyAnalysis.style.display = 'block';
-
-                // Extract safety rating and status
-                const ratingMatch = analysis.match(/SAFETY RATING:\s*(\d+)/i);
-                const statusMatch = analysis.match(/SAFETY STATUS:\s*(SAFE|UNSAFE|CAUTION)/i);
-                const conclusionMatch = analysis.match(/CONCLUSION:\s*(SAFE|UNSAFE|CAUTION)\s*-\s*(.*)/i);
-
-                let formattedAnalysis = analysis;
-
-                // Add prominent safety rating and status at the top
-                if (ratingMatch) {
-                    const rating = parseInt(ratingMatch[1]);
-                    let statusColor, statusText, statusBoxColor;
-
-                    if (rating <= 3) {
-                        statusColor = 'danger';
-                        statusText = 'Extremely Dangerous';
-                        statusBoxColor = '#dc3545'; // Red
-                    } else if (rating <= 5) {
-                        statusColor = 'warning';
-                        statusText = 'High Risk';
-                        statusBoxColor = '#fd7e14'; // Orange
-                    } else if (rating <= 7) {
-                        statusColor = 'info';
-                        statusText = 'Moderate Risk';
-                        statusBoxColor = '#ffc107'; // Yellow
-                    } else if (rating <= 9) {
-                        statusColor = 'success';
-                        statusText = 'Safe';
-                        statusBoxColor = '#28a745'; // Light Green
-                    } else {
-                        statusColor = 'success';
-                        statusText = 'Very Safe';
-                        statusBoxColor = '#20c997'; // Green
-                    }
+    def _process(self, barcode):
+        for attempt in range(EXPORT_ATTEMPTS):
+            try:
+                return self._analyze(barcode)
+            except (SchedulerBusyError, CircuitOpenError) as e:
+                if attempt == EXPORT_ATTEMPTS - 1:
+                    error = str(e)
+                    break
+                time.sleep(e.retry_after)
+            except Exception as e:
+                logger.error(f"Export failed for {barcode}: {str(e)}")
+                error = str(e)
+                break
+        return {'barcode': barcode, 'status': 'error', 'error': error}
+
+    # Results in the order the barcodes were given
+    def run(self):
+        os.makedirs(os.path.dirname(self.checkpoint_path) or '.',
+                    exist_ok=True)
+        self._load_checkpoint()
+        pending = [
+            barcode for barcode in self.barcodes
+            if barcode not in self.results
+        ]
+        if len(pending) < len(self.barcodes):
+            logger.info(f"Resuming export, {len(pending)} of "
+                        f"{len(self.barcodes)} products left")
+        with ThreadPoolExecutor(max_workers=self.workers,
+                                thread_name_prefix='export-item') as pool:
+            for future in as_completed(
+                [pool.submit(self._process, barcode) for barcode in pending]):
+                self._record(future.result())
+        return [self.results[barcode] for barcode in self.barcodes]
+
+    # The product behind an 'ok' result, for its report pages. Results
+    # loaded from a checkpoint are looked up again; None if that fails.
+    def _product(self, barcode):
+        product_data = self.products.get(barcode)
+        if product_data is not None:
+            return product_data
+        try:
+            product_data, _ = fetch_product(barcode)
+        except Exception as e:
+            logger.warning(f"Export cannot reload {barcode}: {str(e)}")
+            return None
+        if product_data is None:
+            logger.warning(f"Export cannot reload {barcode}: not found")
+        return product_data
+
+    # Products that can no longer be loaded keep their summary row but get
+    # no report pages
+    def build_pdf(self, results, images=True):
+        products = {}
+        for result in results:
+            if result['status'] == 'ok':
+                product_data = self._product(result['barcode'])
+                if product_data is not None:
+                    products[result['barcode']] = product_data
+        product_images = {}
+        if images:
+            with ThreadPoolExecutor(max_workers=self.workers,
+                                    thread_name_prefix='export-image') as pool:
+                product_images = dict(
+                    zip(products,
+                        pool.map(download_product_image, products.values())))
+        return run_blocking(generate_catalog_pdf, results, products,
+                            product_images, self.profile)
+
+
+# Shorten text with an ellipsis until it fits width at the current font
+def fit_text(pdf, text, width):
+    text = str(text)
+    if pdf.get_string_width(text) <= width:
+        return text
+    while text and pdf.get_string_width(text + '...') > width:
+        text = text[:-1]
+    return text + '...'
+
+
+# One PDF for a bulk export: a summary table of every product, then the
+# usual per-product report pages for those that were found and analysed
+@metrics.timed('catalog_render')
+def generate_catalog_pdf(results, products, images, profile):
+    from fpdf import FPDF
+    started = time.perf_counter()
+    pdf = FPDF()
+    pdf.set_compression(True)
+    pdf.add_page()
+
+    pdf.set_font("Arial", "B", 16)
+    pdf.cell(0, 10, f"Allergy Report: {len(results)} Products", 0, 1, 'C')
+    pdf.set_font("Arial", "", 11)
+    pdf.multi_cell(0, 7, f"Allergies and conditions: {profile.text}")
+    pdf.cell(0, 7, f"Generated {time.strftime('%Y-%m-%d %H:%M')}", 0, 1)
+    pdf.ln(4)
+
+    columns = (('Barcode', 35), ('Product', 70), ('Verdict', 25),
+               ('Matches', 0))
+    pdf.set_font("Arial", "B", 11)
+    for heading, width in columns:
+        pdf.cell(width, 8, heading, 'B', 1 if width == 0 else 0)
+    pdf.set_font("Arial", "", 10)
+    for result in results:
+        if result['status'] == 'ok':
+            verdict = result.get('verdict') or 'SEE REPORT'
+            if result.get('confidence') is not None:
+                verdict = f"{verdict} ({result['confidence']}%)"
+            row = (result['barcode'], result.get('title', ''), verdict,
+                   ', '.join(result.get('allergen_matches', [])))
+        elif result['status'] == 'not_found':
+            row = (result['barcode'], 'Not in Open Food Facts', '-', '')
+        else:
+            row = (result['barcode'], result.get('error', 'Failed'), 'ERROR',
+                   '')
+        for (_, width), value in zip(columns, row):
+            cell_width = width or pdf.w - pdf.r_margin - pdf.get_x()
+            pdf.cell(width, 7, fit_text(pdf, value, cell_width - 2), 0,
+                     1 if width == 0 else 0)
+
+    for result in results:
+        if result['barcode'] in products:
+            add_product_pages(pdf, products[result['barcode']],
+                              result['allergy_analysis'],
+                              images.get(result['barcode']))
+
+    data = bytes(pdf.output())
+    logger.info(f"Rendered {len(results)} product catalog ({len(data)} "
+                f"bytes) in {time.perf_counter() - started:.2f}s")
+    return data
+
+
+@app.cli.command('export-reports',
+                 help='Check a CSV of barcodes against an allergy list and '
+                 'write one combined PDF report.')
+@click.argument('csv_file', type=click.File('r', encoding='utf-8'))
+@click.option('--allergies', help='Comma-separated allergies and conditions.')
+@click.option('--profile-id', help='A profile compiled by POST /profiles.')
+@click.option('--output',
+              '-o',
+              default='allergy_report.pdf',
+              show_default=True,
+              help='Where to write the PDF.')
+@click.option('--checkpoint',
+              help='Progress file used to resume an interrupted export '
+              '[default: OUTPUT.progress.jsonl].')
+@click.option('--workers', default=EXPORT_WORKERS, show_default=True)
+@click.option('--images/--no-images',
+              default=True,
+              help='Include product photos on the report pages.')
+def export_reports(csv_file, allergies, profile_id, output, checkpoint,
+                   workers, images):
+    try:
+        profile = profile_registry.resolve(profile_id, allergies)
+    except ProfileNotFoundError as e:
+        raise click.UsageError(str(e))
+    if profile is None:
+        raise click.UsageError('Give --allergies or --profile-id.')
+    barcodes = read_barcodes(csv_file)
+    if not barcodes:
+        raise click.UsageError('No barcodes found in the CSV file.')
+
+    def progress(done, total, result):
+        status = result.get('verdict') or result['status'].upper()
+        click.echo(f"[{done}/{total}] {result['barcode']} {status}")
+
+    export = BulkExport(barcodes,
+                        profile,
+                        checkpoint or f'{output}.progress.jsonl',
+                        workers=workers,
+                        progress=progress)
+    results = export.run()
+    failed = sum(result['status'] == 'error' for result in results)
+    with open(output, 'wb') as f:
+        f.write(export.build_pdf(results, images=images))
+    click.echo(f"Wrote {output} ({len(results)} products, {failed} failed)")
+    if failed:
+        click.echo("Run the same command again to retry the failures.")
+
+
+# Exports started over HTTP run in the background; their state is kept in
+# the shared cache tier and their checkpoints under CACHE_DIR
+exports = make_cache('exports', 200, json.dumps, json.loads)
+export_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='export')
+
+
+def run_export(record):
+    try:
+        profile = profile_registry.get(record['profile_id'])
+
+        def progress(done, total, result):
+            record['done'] = done
+            record['heartbeat'] = time.time()
+            if result['status'] == 'error':
+                record['failed'] += 1
+            exports.set(record['id'], record)
+
+        export = BulkExport(record['barcodes'],
+                            profile,
+                            os.path.join(CACHE_DIR, 'exports',
+                                         f"{record['id']}.jsonl"),
+                            progress=progress)
+        results = export.run()
+        report_cache.set(f"export-{record['id']}", export.build_pdf(results))
+        record.update({
+            'status': 'done',
+            'done': len(results),
+            'failed': sum(result['status'] == 'error' for result in results),
+            'pdf_url': f"/exports/{record['id']}/pdf"
+        })
+    except Exception as e:
+        logger.error(f"Export {record['id']} failed: {str(e)}", exc_info=True)
+        record.update({'status': 'error', 'error': str(e)})
+    exports.set(record['id'], record)
+
+
+def start_export(record):
+    record.update({
+        'status': 'running',
+        'done': 0,
+        'failed': 0,
+        'heartbeat': time.time()
+    })
+    record.pop('error', None)
+    exports.set(record['id'], record)
+    export_executor.submit(run_export, record)
+
+
+def export_status(record):
+    status = {key: value for key, value in record.items() if key != 'barcodes'}
+    status['total'] = len(record['barcodes'])
+    status['status_url'] = f"/exports/{record['id']}"
+    return status
+
+
+# Start a bulk export. Takes a CSV upload ('barcodes' file) with
+# allergies/profile_id form fields, or JSON with a 'barcodes' list.
+@app.route('/exports', methods=['POST'])
+def create_export():
+    if request.is_json:
+        data = request.json or {}
+        barcodes = read_barcodes(str(code) for code in data.get('barcodes', []))
+    else:
+        data = request.form
+        upload = request.files.get('barcodes')
+        if upload is None:
+            return jsonify({'error': 'No barcode list uploaded'}), 400
+        barcodes = read_barcodes(
+            io.TextIOWrapper(upload.stream, encoding='utf-8', newline=''))
+    if not barcodes:
+        return jsonify({'error': 'No barcodes provided'}), 400
+    if len(barcodes) > EXPORT_MAX_BARCODES:
+        return jsonify({
+            'error':
+            f'At most {EXPORT_MAX_BARCODES} barcodes per export'
+        }), 400
 
-                    formattedAnalysis = `
-                        <div class="safety-rating-box" style="
-                            background-color: ${statusBoxColor};
-                            color: white;
-                            padding: 20px;
-                            border-radius: 10px;
-                            margin-bottom: 20px;
-                            box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-                        ">
-                            <div class="d-flex justify-content-between align-items-center">
-                                <div>
-                                    <h3 class="mb-2" style="margin: 0;">Safety Rating: ${rating}/10</h3>
-                                    <h4 class="mb-0" style="margin: 0;">${statusText}</h4>
-                                </div>
-                                <div class="text-end">
-                                    <div class="progress" style="width: 120px; height: 25px; background-color: rgba(255,255,255,0.3);">
-                                        <div class="progress-bar bg-white" role="progressbar"
-                                             style="width: ${rating * 10}%"
-                                             aria-valuenow="${rating}"
-                                             aria-valuemin="0"
-                                             aria-valuemax="10">
-                                            ${rating}/10
-                                        </div>
-                                    </div>
-                                </div>
-                            </div>
-                        </div>
-                        ${formattedAnalysis}
-                    `;
-                }
+    try:
+        profile = profile_registry.resolve(data.get('profile_id'),
+                                           data.get('allergies', ''))
+    except ProfileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    if profile is None:
+        return jsonify({'error': 'No allergies or profile_id provided'}), 400
+
+    record = {
+        'id': uuid.uuid4().hex,
+        'profile_id': profile.id,
+        'barcodes': barcodes
+    }
+    start_export(record)
+    return jsonify(export_status(record)), 202
+
+
+@app.route('/exports/<export_id>')
+def get_export(export_id):
+    cached = exports.get(export_id, EXPORT_TTL)
+    if not cached:
+        return jsonify({'error': 'Unknown or expired export'}), 404
+    record = cached[0]
+    return jsonify(export_status(record)), (200 if record['status']
+                                            in ('done', 'error') else 202)
+
+
+# Continue an export that failed or whose worker went away, reusing the
+# products already finished
+@app.route('/exports/<export_id>/resume', methods=['POST'])
+def resume_export(export_id):
+    cached = exports.get(export_id, EXPORT_TTL)
+    if not cached:
+        return jsonify({'error': 'Unknown or expired export'}), 404
+    record = cached[0]
+    if record['status'] == 'done':
+        return jsonify({'error': 'Export already finished'}), 409
+    # A second run would append to the same checkpoint file. A running
+    # export that has stopped reporting progress is taken to have died with
+    # its worker.
+    if (record['status'] == 'running' and
+            time.time() - record.get('heartbeat', 0) < EXPORT_STALL_SECONDS):
+        return jsonify({'error': 'Export is still running'}), 409
+    start_export(record)
+    return jsonify(export_status(record)), 202
+
+
+@app.route('/exports/<export_id>/pdf')
+def download_export(export_id):
+    cached = report_cache.get(f'export-{export_id}', EXPORT_TTL)
+    if not cached:
+        return jsonify({'error': 'Export not finished or expired'}), 404
+    return send_file(io.BytesIO(cached[0]),
+                     as_attachment=True,
+                     download_name=f'allergy_report_{export_id[:8]}.pdf',
+                     mimetype='application/pdf')
+
+
+# Uploads are capped before they are decoded: by body size (Flask rejects
+# larger requests from the Content-Length header without reading them) and
+# by pixel count, read from the image header. The pixel cap also bounds
+# every other image Pillow opens, e.g. product photos for reports.
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 15 * 1024 * 1024))
+MAX_UPLOAD_PIXELS = int(os.getenv('MAX_UPLOAD_PIXELS', 50_000_000))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+Image.MAX_IMAGE_PIXELS = MAX_UPLOAD_PIXELS
+# Longest side, in pixels, uploads are decoded at. Barcodes decode fine well
+# below phone camera resolution; OCR needs a bit more for small print.
+BARCODE_MAX_SIDE = int(os.getenv('BARCODE_MAX_SIDE', 1600))
+OCR_MAX_SIDE = int(os.getenv('OCR_MAX_SIDE', 2500))
+
+# Brands in the ftyp box of HEIF files written by phone cameras
+HEIC_BRANDS = {b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1',
+               b'msf1'}
+
+
+class UploadRejected(Exception):
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    return jsonify({
+        'error':
+        f'Upload too large. The limit is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.'
+    }), 413
+
+
+# Identify an image from its first bytes rather than trusting the file name.
+# Returns 'jpeg', 'png', 'gif' or 'heic', or None for anything else.
+def sniff_image_type(header):
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if header[4:8] == b'ftyp' and header[8:12] in HEIC_BRANDS:
+        return 'heic'
+    return None
+
+
+def check_image_pixels(size):
+    width, height = size
+    if width * height > MAX_UPLOAD_PIXELS:
+        raise UploadRejected(
+            f'Image is too large ({width}x{height}). The limit is '
+            f'{MAX_UPLOAD_PIXELS // 1_000_000} megapixels.', 413)
+
+
+# Stream an uploaded image to a temporary file after checking what it is and
+# how big it is, both from the header alone. HEIC is converted to JPEG.
+# Returns the path of a file the caller must remove; raises UploadRejected.
+def save_upload_image(file):
+    header = file.stream.read(32)
+    file.stream.seek(0)
+    image_type = sniff_image_type(header)
+    if image_type is None:
+        logger.warning(f"Unsupported upload content: {header[:12]!r}")
+        raise UploadRejected(
+            'Unsupported file format. Please upload JPG, PNG, GIF, or HEIC images only.',
+            400)
+
+    temp_img = tempfile.NamedTemporaryFile(delete=False,
+                                           suffix=f'.{image_type}')
+    temp_img.close()
+    image_path = temp_img.name
+    try:
+        file.save(image_path)
+        logger.debug(f"Saved {image_type} upload to {image_path}")
+        if image_type == 'heic':
+            import pillow_heif
+            try:
+                heif_size = pillow_heif.open_heif(image_path).size
+            except (ValueError, RuntimeError, OSError, SyntaxError) as e:
+                logger.warning(f"Unreadable HEIC upload: {str(e)}")
+                raise UploadRejected('The uploaded image could not be read.',
+                                     400)
+            check_image_pixels(heif_size)
+            try:
+                image_path = run_blocking(convert_heic_to_jpeg, image_path)
+            except Exception as heic_error:
+                logger.error(f"Error converting HEIC image: {str(heic_error)}")
+                raise UploadRejected(
+                    'Failed to process HEIC image. Please try converting to JPEG first.',
+                    500)
+            logger.debug("Successfully converted HEIC to JPEG")
+            return image_path
+        try:
+            with Image.open(image_path) as image:
+                check_image_pixels(image.size)
+        except Image.DecompressionBombError:
+            raise UploadRejected(
+                f'Image is too large. The limit is '
+                f'{MAX_UPLOAD_PIXELS // 1_000_000} megapixels.', 413)
+        except (OSError, SyntaxError) as e:
+            logger.warning(f"Unreadable upload: {str(e)}")
+            raise UploadRejected('The uploaded image could not be read.', 400)
+        return image_path
+    except BaseException:
+        if os.path.exists(image_path):
+            os.unlink(image_path)
+        raise
 
-                // Format the analysis text
-                formattedAnalysis = formattedAnalysis.replace(/\\n/g, '<br>');
-
-                // Add highlighted conclusion if available
-                if (conclusionMatch) {
-                    const status = conclusionMatch[1].toUpperCase();
-                    const explanation = conclusionMatch[2];
-                    const statusColor = status === 'SAFE' ? 'success' :
-                                      status === 'UNSAFE' ? 'danger' : 'warning';
-                    formattedAnalysis += `
-                        <div class="alert alert-${statusColor} mt-3">
-                            <strong>Final Decision:</strong> ${status}<br>
-                            ${explanation}
-                        </div>
-                    `;
-                }
 
-                allergyAnalysis.innerHTML = formattedAnalysis;
-            }
-        });
-    </script>
-</body>
-</html>
-    ''')
+# Open an image at no more than max_side pixels on its longest side, in the
+# given mode. JPEGs are decoded at a reduced scale straight away (draft
+# mode), so a 12 MP photo never exists in memory at full size.
+def open_reduced(image_path, max_side, mode='L'):
+    image = Image.open(image_path)
+    image.draft(mode, (max_side, max_side))
+    image = image.convert(mode)
+    image.thumbnail((max_side, max_side))
+    return image
+
+
+# Convert an uploaded HEIC image to a temporary JPEG and remove the original.
+# The JPEG is no larger than any consumer decodes it at. Returns its path.
+@metrics.timed('heic_convert')
+def convert_heic_to_jpeg(heic_path):
+    import pillow_heif
+    heif_file = pillow_heif.open_heif(heic_path)
+    image = heif_file.to_pillow()
+    max_side = max(BARCODE_MAX_SIDE, OCR_MAX_SIDE)
+    image.thumbnail((max_side, max_side))
+    # Save as temporary JPEG
+    jpeg_temp = tempfile.NamedTemporaryFile(delete=False, suffix='.jpg')
+    jpeg_temp.close()
+    image.convert('RGB').save(jpeg_temp.name, format='JPEG', quality=90)
+    # Clean up original HEIC temp file
+    os.unlink(heic_path)
+    return jpeg_temp.name
+
+
+# Try the image as uploaded and with a few preprocessing steps until a
+# barcode decodes. Returns (decoded_objects, method), or (None, None).
+def find_barcodes(image_path):
+    import cv2
+    import numpy as np
+    from pyzbar.pyzbar import decode
+    # zbar works on grayscale anyway; decode once, reduced, and derive
+    # every attempt from that
+    with metrics.timed('image_load'):
+        image = open_reduced(image_path, BARCODE_MAX_SIDE)
+    logger.debug(f"Opened image at {image.size[0]}x{image.size[1]}")
+
+    # List to store all processing attempts
+    processing_attempts = []
+
+    # Original image attempt
+    processing_attempts.append(("Original", image))
+
+    # Enhance contrast
+    enhancer = ImageEnhance.Contrast(image)
+    enhanced_image = enhancer.enhance(2.0)  # Increase contrast
+    processing_attempts.append(("Enhanced Contrast", enhanced_image))
+
+    # Apply adaptive thresholding
+    thresh = cv2.adaptiveThreshold(np.asarray(image), 255,
+                                   cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                   cv2.THRESH_BINARY, 11, 2)
+    thresh_pil = Image.fromarray(thresh)
+    processing_attempts.append(("Adaptive Threshold", thresh_pil))
+
+    # Try decoding with each processed image
+    for method, processed_image in processing_attempts:
+        started = time.perf_counter()
+        try:
+            decoded_objects = decode(processed_image)
+        except Exception as e:
+            logger.debug(f"Failed to decode with {method}: {str(e)}")
+            decoded_objects, result = None, 'error'
+        else:
+            result = 'found' if decoded_objects else 'none'
+        metrics.observe('barcode_decode_seconds',
+                        time.perf_counter() - started,
+                        method=method,
+                        result=result)
+        if decoded_objects:
+            logger.debug(f"Successfully decoded barcode using {method}")
+            return decoded_objects, method
+
+    return None, None
+
+
+@metrics.timed('ocr')
+def extract_ingredients_text(image_path):
+    import pytesseract
+    image = open_reduced(image_path, OCR_MAX_SIDE)
+    ingredients_text = pytesseract.image_to_string(image, lang='eng')
+    # Clean and normalize the text
+    ingredients_text = ingredients_text.strip()
+    ingredients_text = ' '.join(
+        ingredients_text.split())  # Normalize whitespace
+    ingredients_text = ingredients_text.encode(
+        'ascii', 'ignore').decode('ascii')  # Remove non-ASCII chars
+    return ingredients_text
+
+
+# Load the modules and Gemini models kept off the import path, so the first
+# upload or analysis does not pay for them. Safe to call more than once.
+def warm_up():
+    started = time.perf_counter()
+    for module in ('cv2', 'pytesseract', 'pillow_heif', 'fpdf',
+                   'pyzbar.pyzbar', 'google.api_core.exceptions'):
+        try:
+            importlib.import_module(module)
+        except Exception as e:
+            logger.warning(f"Warm-up could not import {module}: {str(e)}")
+    for gemini_model in (model, fast_model, translation_model):
+        if gemini_model is not None:
+            gemini_model.load()
+    logger.info(
+        f"Warm-up finished in {time.perf_counter() - started:.2f}s")
 
 
 # Add new route for image upload
@@ -1196,100 +3786,21 @@ def upload_barcode():
             logger.warning("No file uploaded")
             return jsonify({'error': 'No image uploaded'}), 400
 
-        # Check file format
-        allowed_extensions = {'jpg', 'jpeg', 'png', 'gif', 'heic'}
-        file_extension = file.filename.rsplit(
-            '.', 1)[1].lower() if '.' in file.filename else ''
-        if file_extension not in allowed_extensions:
-            logger.warning(f"Unsupported file format: {file_extension}")
-            return jsonify({
-                'error':
-                'Unsupported file format. Please upload JPG, PNG, GIF, or HEIC images only.'
-            }), 400
-
-        # Save the uploaded image temporarily
-        temp_img = tempfile.NamedTemporaryFile(delete=False,
-                                               suffix=f'.{file_extension}')
-        file.save(temp_img.name)
-        logger.debug(f"Saved temporary image to {temp_img.name}")
+        try:
+            profile = profile_registry.resolve(request.form.get('profile_id'),
+                                               allergies)
+        except ProfileNotFoundError as e:
+            return jsonify({'error': str(e)}), 404
 
         try:
-            # Handle HEIC format
-            if file_extension == 'heic':
-                try:
-                    # Read HEIC file
-                    heif_file = pillow_heif.read_heif(temp_img.name)
-                    # Convert to PIL Image
-                    image = Image.frombytes(
-                        heif_file.mode,
-                        heif_file.size,
-                        heif_file.data,
-                        "raw",
-                    )
-                    # Save as temporary JPEG
-                    jpeg_temp = tempfile.NamedTemporaryFile(delete=False,
-                                                            suffix='.jpg')
-                    image.save(jpeg_temp.name, format='JPEG')
-                    # Clean up original HEIC temp file
-                    os.unlink(temp_img.name)
-                    # Update temp_img to point to the JPEG file
-                    temp_img = jpeg_temp
-                    logger.debug("Successfully converted HEIC to JPEG")
-                except Exception as heic_error:
-                    logger.error(
-                        f"Error converting HEIC image: {str(heic_error)}")
-                    return jsonify({
-                        'error':
-                        'Failed to process HEIC image. Please try converting to JPEG first.'
-                    }), 500
+            image_path = save_upload_image(file)
+        except UploadRejected as e:
+            return jsonify({'error': str(e)}), e.status_code
 
+        try:
             # Try multiple image processing techniques to improve barcode detection
-            image = Image.open(temp_img.name)
-            logger.debug("Successfully opened image")
-
-            # List to store all processing attempts
-            processing_attempts = []
-
-            # Original image attempt
-            processing_attempts.append(("Original", image))
-
-            # Convert to grayscale
-            if image.mode != 'L':
-                gray_image = image.convert('L')
-                processing_attempts.append(("Grayscale", gray_image))
-
-            # Enhance contrast
-            enhancer = ImageEnhance.Contrast(image)
-            enhanced_image = enhancer.enhance(2.0)  # Increase contrast
-            processing_attempts.append(("Enhanced Contrast", enhanced_image))
-
-            # Convert to OpenCV format for additional processing
-            cv_image = cv2.imread(temp_img.name)
-            if cv_image is not None:
-                # Apply adaptive thresholding
-                gray = cv2.cvtColor(cv_image, cv2.COLOR_BGR2GRAY)
-                thresh = cv2.adaptiveThreshold(gray, 255,
-                                               cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                               cv2.THRESH_BINARY, 11, 2)
-                thresh_pil = Image.fromarray(thresh)
-                processing_attempts.append(("Adaptive Threshold", thresh_pil))
-
-            decoded_objects = None
-            successful_method = None
-
-            # Try decoding with each processed image
-            for method, processed_image in processing_attempts:
-                try:
-                    current_decoded = decode(processed_image)
-                    if current_decoded:
-                        decoded_objects = current_decoded
-                        successful_method = method
-                        logger.debug(
-                            f"Successfully decoded barcode using {method}")
-                        break
-                except Exception as e:
-                    logger.debug(f"Failed to decode with {method}: {str(e)}")
-                    continue
+            decoded_objects, successful_method = run_blocking(
+                find_barcodes, image_path)
 
             if not decoded_objects:
                 logger.warning(
@@ -1306,49 +3817,75 @@ def upload_barcode():
 
             # Get product information from API
             logger.debug(f"Fetching product info for barcode: {barcode}")
-            response = requests.get(f"{API_URL}/{barcode}.json",
-                                    params={'lc': 'en'})
-
-            if response.status_code != 200:
+            recheck = request.form.get('recheck', 'false').lower() == 'true'
+            full = request.form.get('full', 'false').lower() == 'true'
+            try:
+                product_data, data_age = fetch_product(barcode,
+                                                       recheck=recheck)
+                full_product = (fetch_full_product(barcode) if full
+                                and product_data is not None else None)
+            except ProductAPIError as e:
                 logger.error(
-                    f"API request failed with status {response.status_code}: {response.text}"
+                    f"API request failed with status {e.status_code}: {e.text}"
                 )
                 return jsonify({
                     'error':
-                    f'Failed to fetch product information. Status code: {response.status_code}'
+                    f'Failed to fetch product information. Status code: {e.status_code}'
                 }), 500
+            except CircuitOpenError as e:
+                logger.warning(str(e))
+                return jsonify({'error': str(e)}), 503, {
+                    'Retry-After': str(e.retry_after)
+                }
 
-            product_data = response.json()
-
-            if product_data.get('status') == 0:
+            if product_data is None:
                 logger.warning(f"Product not found for barcode: {barcode}")
                 return jsonify({'error': 'Product not found in database'}), 404
 
-            # Check allergies if provided
+            # Check allergies if provided. The analysis and the report with
+            # it (whose image download overlaps the analysis) are produced
+            # together; without one the report is rendered on download.
             allergy_analysis = None
-            if allergies:
-                logger.debug(f"Checking allergies: {allergies}")
-                ingredients = product_data.get('product',
-                                               {}).get('ingredients_text', '')
+            allergen_matches = []
+            pdf_url = f'/download_pdf?barcode={barcode}'
+            if profile:
+                logger.debug(f"Checking allergies: {profile.text}")
+                ingredients = product_data.ingredients
                 if ingredients:
-                    allergy_analysis = check_allergies(ingredients, allergies)
+                    job = start_analysis_job(barcode,
+                                             product_data,
+                                             ingredients,
+                                             profile,
+                                             wait=True,
+                                             priority=PRIORITY_UPLOAD)
+                    if job.get('retry_after'):
+                        return jsonify({'error': job['error']}), job[
+                            'error_status'], {
+                                'Retry-After': str(job['retry_after'])
+                            }
+                    if job['status'] == 'error':
+                        raise RuntimeError(job['error'])
+                    allergy_analysis = job['allergy_analysis']
+                    pdf_url = job['pdf_url']
+                    allergen_matches = profile.matches(ingredients)
                     logger.debug("Allergy analysis completed")
 
-            # Generate PDF
-            temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            temp_pdf.close()
-            logger.debug(f"Created temporary PDF file: {temp_pdf.name}")
-
-            generate_pdf(product_data, temp_pdf.name, allergy_analysis)
-            logger.debug("PDF generated successfully")
-
             return jsonify({
                 'success': True,
-                'product': product_data,
+                'product': full_product or project_product(product_data),
                 'allergy_analysis': allergy_analysis,
-                'pdf_url': f'/download_pdf?barcode={barcode}'
+                'pdf_url': pdf_url,
+                'data_age_seconds': int(data_age),
+                'stale': data_age > PRODUCT_CACHE_TTL,
+                'profile_id': profile.id if profile else None,
+                'allergen_matches': allergen_matches
             })
 
+        except SchedulerBusyError as e:
+            logger.warning(str(e))
+            return jsonify({'error': str(e)}), 429, {
+                'Retry-After': str(e.retry_after)
+            }
         except Exception as process_error:
             logger.error(
                 f"Error processing barcode image: {str(process_error)}")
@@ -1360,13 +3897,17 @@ def upload_barcode():
         finally:
             # Clean up temp file
             try:
-                if os.path.exists(temp_img.name):
-                    os.unlink(temp_img.name)
+                if os.path.exists(image_path):
+                    os.unlink(image_path)
                     logger.debug("Temporary image file cleaned up")
             except Exception as cleanup_error:
                 logger.error(
                     f"Error cleaning up temporary file: {str(cleanup_error)}")
 
+    except RequestEntityTooLarge:
+        # Bodies without a Content-Length only hit the cap while the form
+        # is read; let the 413 handler answer
+        raise
     except Exception as e:
         logger.error(f"General Error in upload_barcode: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
@@ -1385,61 +3926,21 @@ def upload_ingredients():
         if not file:
             return jsonify({'error': 'No image uploaded'}), 400
 
-        # Check file format
-        allowed_extensions = {'jpg', 'jpeg', 'png', 'gif', 'heic'}
-        file_extension = file.filename.rsplit(
-            '.', 1)[1].lower() if '.' in file.filename else ''
-        if file_extension not in allowed_extensions:
-            logger.warning(f"Unsupported file format: {file_extension}")
-            return jsonify({
-                'error':
-                'Unsupported file format. Please upload JPG, PNG, GIF, or HEIC images only.'
-            }), 400
-
-        # Save the uploaded image temporarily
-        temp_img = tempfile.NamedTemporaryFile(delete=False,
-                                               suffix=f'.{file_extension}')
-        file.save(temp_img.name)
+        try:
+            profile = profile_registry.resolve(request.form.get('profile_id'),
+                                               allergies)
+        except ProfileNotFoundError as e:
+            return jsonify({'error': str(e)}), 404
 
         try:
-            # Handle HEIC format
-            if file_extension == 'heic':
-                try:
-                    # Read HEIC file
-                    heif_file = pillow_heif.read_heif(temp_img.name)
-                    # Convert to PIL Image
-                    image = Image.frombytes(
-                        heif_file.mode,
-                        heif_file.size,
-                        heif_file.data,
-                        "raw",
-                    )
-                    # Save as temporary JPEG
-                    jpeg_temp = tempfile.NamedTemporaryFile(delete=False,
-                                                            suffix='.jpg')
-                    image.save(jpeg_temp.name, format='JPEG')
-                    # Clean up original HEIC temp file
-                    os.unlink(temp_img.name)
-                    # Update temp_img to point to the JPEG file
-                    temp_img = jpeg_temp
-                    logger.debug("Successfully converted HEIC to JPEG")
-                except Exception as heic_error:
-                    logger.error(
-                        f"Error converting HEIC image: {str(heic_error)}")
-                    return jsonify({
-                        'error':
-                        'Failed to process HEIC image. Please try converting to JPEG first.'
-                    }), 500
+            image_path = save_upload_image(file)
+        except UploadRejected as e:
+            return jsonify({'error': str(e)}), e.status_code
 
+        try:
             # Extract text from image using OCR with proper encoding
-            image = Image.open(temp_img.name)
-            ingredients_text = pytesseract.image_to_string(image, lang='eng')
-            # Clean and normalize the text
-            ingredients_text = ingredients_text.strip()
-            ingredients_text = ' '.join(
-                ingredients_text.split())  # Normalize whitespace
-            ingredients_text = ingredients_text.encode(
-                'ascii', 'ignore').decode('ascii')  # Remove non-ASCII chars
+            ingredients_text = run_blocking(extract_ingredients_text,
+                                            image_path)
 
             if not ingredients_text:
                 return jsonify({'error':
@@ -1454,47 +3955,64 @@ def upload_ingredients():
         finally:
             # Clean up temp file
             try:
-                os.unlink(temp_img.name)
+                os.unlink(image_path)
             except:
                 pass
 
         # Check allergies against extracted ingredients
         try:
-            allergy_analysis = check_allergies(ingredients_text, allergies)
+            allergy_analysis = check_allergies(ingredients_text, profile
+                                               or allergies)
+        except SchedulerBusyError as e:
+            logger.warning(str(e))
+            return jsonify({'error': str(e)}), 429, {
+                'Retry-After': str(e.retry_after)
+            }
         except Exception as analysis_error:
             logger.error(f"Allergy Analysis Error: {str(analysis_error)}")
             return jsonify({'error': 'Failed to analyze ingredients'}), 500
 
         # Generate PDF
         try:
-            temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            temp_pdf.close()
-
             # Create a simple product data structure for the PDF
-            product_data = {
-                'product': {
-                    'product_name': 'Custom Product Analysis',
-                    'ingredients_text': ingredients_text
-                }
-            }
+            product_data = ProductRecord(
+                product_name='Custom Product Analysis',
+                ingredients_text=ingredients_text)
 
-            generate_pdf(product_data, temp_pdf.name, allergy_analysis)
+            report_id = uuid.uuid4().hex
+            report_cache.set(
+                report_id,
+                run_blocking(generate_pdf, product_data, allergy_analysis))
 
             return jsonify({
                 'success': True,
                 'ingredients': ingredients_text,
                 'allergy_analysis': allergy_analysis,
-                'pdf_url': f'/download_pdf?custom=true'
+                'profile_id': profile.id if profile else None,
+                'allergen_matches':
+                profile.matches(ingredients_text) if profile else [],
+                'pdf_url': f'/download_pdf?custom=true&report={report_id}'
             })
 
         except Exception as pdf_error:
             logger.error(f"PDF Generation Error: {str(pdf_error)}")
             return jsonify({'error': 'Failed to generate PDF report'}), 500
 
+    except RequestEntityTooLarge:
+        # Bodies without a Content-Length only hit the cap while the form
+        # is read; let the 413 handler answer
+        raise
     except Exception as e:
         logger.error(f"General Error in upload_ingredients: {str(e)}")
         return jsonify({'error': 'An unexpected error occurred'}), 500
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5004, debug=True)
+    if SERVER_MODE == 'async':
+        from gevent.pywsgi import WSGIServer
+        logger.info("Serving on 0.0.0.0:5004 with gevent")
+        WSGIServer(('0.0.0.0', 5004), app).serve_forever()
+    else:
+        # Development server only; production runs `gunicorn app:app`
+        # with the settings in gunicorn.conf.py.
+        app.run(host='0.0.0.0', port=5004, debug=True)
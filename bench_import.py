@@ -0,0 +1,75 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Measures how long a fresh interpreter takes to import app.py, which is
+# most of a new container's cold start, and checks that the heavy modules
+# app.py loads lazily have stayed off the import path.
+#
+#   python bench_import.py --runs 10 --max-seconds 0.8
+#
+# Exits non-zero when the median import time is over --max-seconds or a
+# lazy module was imported eagerly, so it can gate CI.
+
+LAZY_MODULES = ('cv2', 'numpy', 'pytesseract', 'pyzbar', 'pillow_heif',
+                'fpdf', 'google.generativeai', 'google.api_core')
+
+MEASURE = '''
+import sys, time
+started = time.perf_counter()
+import app
+elapsed = time.perf_counter() - started
+loaded = [name for name in sys.argv[1:] if name in sys.modules]
+print(elapsed)
+print(','.join(loaded))
+'''
+
+
+def measure_once():
+    env = dict(os.environ)
+    env.setdefault('GEMINI_API_KEY', 'benchmark')
+    result = subprocess.run(
+        [sys.executable, '-c', MEASURE, *LAZY_MODULES],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True)
+    elapsed, loaded = result.stdout.split('\n')[-3:-1]
+    return float(elapsed), [name for name in loaded.split(',') if name]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the cold import time of app.py')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=None)
+    args = parser.parse_args()
+
+    timings = []
+    eager = set()
+    for _ in range(args.runs):
+        elapsed, loaded = measure_once()
+        timings.append(elapsed)
+        eager.update(loaded)
+
+    median = statistics.median(timings)
+    print(f"import app: median {median:.3f}s, "
+          f"min {min(timings):.3f}s, max {max(timings):.3f}s "
+          f"over {args.runs} runs")
+
+    failed = False
+    if eager:
+        print(f"Imported eagerly: {', '.join(sorted(eager))}")
+        failed = True
+    if args.max_seconds is not None and median > args.max_seconds:
+        print(f"Median import time is over the {args.max_seconds:.3f}s "
+              f"budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
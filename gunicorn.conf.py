@@ -0,0 +1,104 @@
+import gc
+import multiprocessing
+import os
+
+# Production server settings, picked up automatically by:
+#   gunicorn app:app
+# Every value can be overridden from the environment. `kill -TERM` on the
+# master drains the workers and exits.
+#
+# With preload_app (the default) the master holds the app, so `kill -HUP`
+# only re-forks workers from the code already loaded: it picks up
+# configuration changes, not new code. To deploy new code on the same
+# socket without dropping requests:
+#   kill -USR2 <master>      start a new master and workers on the new code
+#   kill -WINCH <old master> once they are up, retire the old workers
+#   kill -QUIT <old master>  then stop the old master
+# With PRELOAD_APP=false each worker imports the app itself and `kill -HUP`
+# does load new code.
+
+# The app logs at DEBUG when run directly; keep production quieter unless
+# asked otherwise. Set before the app module is imported.
+os.environ.setdefault('LOG_LEVEL', 'INFO')
+
+bind = os.getenv('BIND', f"0.0.0.0:{os.getenv('PORT', '5004')}")
+
+# One process per core plus one, so CPU-bound work (OCR, image decoding,
+# PDF rendering) scales with the machine and one busy worker never stalls
+# the rest.
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() + 1))
+
+# Threaded mode: each worker serves several requests at once, which covers
+# the time spent waiting on Open Food Facts and Gemini. Async mode runs
+# gevent workers with many cheap connections each instead.
+#
+# A /ws/scan camera session holds one of these threads for as long as the
+# camera is open, so in threaded mode at most workers * GUNICORN_THREADS
+# scanners can be connected, and every open one takes a thread away from
+# ordinary requests. Deployments expecting more than a handful of camera
+# sessions should run SERVER_MODE=async, where a session costs a greenlet.
+if os.getenv('SERVER_MODE', 'threaded') == 'async':
+    worker_class = 'gevent'
+    worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
+else:
+    worker_class = 'gthread'
+    threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+# Import the app once in the master and fork the workers from it. The app
+# keeps OpenCV, Tesseract, FPDF and the Gemini SDK off its import path, so
+# when_ready loads them in the master too, before the first fork; workers
+# then start fast and share those pages copy-on-write.
+preload_app = os.getenv('PRELOAD_APP', 'true').lower() == 'true'
+
+# A request stuck longer than this gets its worker restarted. Allergy
+# analysis can escalate to the larger model, so this is well above a
+# normal request.
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+# How long workers get to finish in-flight requests on restart or shutdown.
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('KEEPALIVE', 5))
+
+# Recycle workers now and then so slow leaks in native libraries can't
+# build up; the jitter keeps them from all restarting at once.
+max_requests = int(os.getenv('MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.getenv('MAX_REQUESTS_JITTER', 200))
+
+accesslog = os.getenv('ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'INFO').lower()
+
+
+# Move everything the preloaded app allocated into the permanent
+# generation. Otherwise the first garbage collection in each worker touches
+# every object's header and un-shares the pages forked from the master.
+def pre_fork(server, worker):
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    server.log.info(f"Worker spawned (pid: {worker.pid})")
+
+
+def warm_up_enabled():
+    return os.getenv('WARM_UP', 'true').lower() == 'true'
+
+
+# Runs in the master after the preloaded app is imported and before any
+# worker is forked: load the OCR, image, PDF and Gemini modules the app
+# imports lazily, so every worker inherits them. No Gemini connection is
+# opened here.
+def when_ready(server):
+    if server.cfg.preload_app and warm_up_enabled():
+        from app import warm_up
+        warm_up()
+
+
+# Without preloading each worker imports the app itself; load the same
+# modules in the background right after it starts so it can take requests
+# straight away and the first upload does not pay for them either.
+def post_worker_init(worker):
+    if worker.cfg.preload_app or not warm_up_enabled():
+        return
+    import threading
+    from app import warm_up
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
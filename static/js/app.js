@@ -0,0 +1,630 @@
+document.addEventListener('DOMContentLoaded', function() {
+    const startButton = document.getElementById('startButton');
+    const stopButton = document.getElementById('stopButton');
+    const manualSubmit = document.getElementById('manualSubmit');
+    const barcodeInput = document.getElementById('barcodeInput');
+    const allergiesInput = document.getElementById('allergiesInput');
+    const productInfo = document.getElementById('productInfo');
+    const productTitle = document.getElementById('productTitle');
+    const productDetails = document.getElementById('productDetails');
+    const productImage = document.getElementById('productImage');
+    const allergyAnalysis = document.getElementById('allergyAnalysis');
+    const downloadButton = document.getElementById('downloadButton');
+    const loadingOverlay = document.getElementById('loadingOverlay');
+    const cameraPermissionAlert = document.getElementById('cameraPermissionAlert');
+
+    const sessionStatus = document.getElementById('sessionStatus');
+    const cameraAllergiesInput = document.getElementById('cameraAllergiesInput');
+
+    let downloadUrl = '';
+
+    // Scanning session: while the camera runs, detected codes are
+    // streamed over one WebSocket and results are pushed back
+    let scanSocket = null;
+    let displayedBarcode = null;
+
+    function showSessionStatus(message) {
+        sessionStatus.textContent = message;
+        sessionStatus.style.display = 'block';
+    }
+
+    function sendSessionStart() {
+        scanSocket.send(JSON.stringify({
+            type: 'start',
+            allergies: cameraAllergiesInput.value.trim()
+        }));
+    }
+
+    function openScanSession() {
+        if (!('WebSocket' in window)) {
+            return;
+        }
+        const protocol = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
+        const socket = new WebSocket(protocol + window.location.host + '/ws/scan');
+        scanSocket = socket;
+
+        socket.onopen = sendSessionStart;
+        socket.onmessage = function(event) {
+            const message = JSON.parse(event.data);
+            if (message.type === 'product') {
+                displayedBarcode = message.barcode;
+                handleBarcodeSuccess({
+                    product: message.product,
+                    pdf_url: message.pdf_url,
+                    allergy_analysis: null
+                });
+                const name = message.product.product.product_name || message.barcode;
+                showSessionStatus(cameraAllergiesInput.value.trim() ?
+                    'Found ' + name + '. Analyzing ingredients...' : 'Found ' + name + '.');
+            } else if (message.type === 'verdict') {
+                if (message.barcode === displayedBarcode && message.allergy_analysis) {
+                    displayAllergyAnalysis(message.allergy_analysis);
+                    showSessionStatus('Analysis ready for ' + message.barcode + '. Keep scanning.');
+                }
+            } else if (message.type === 'error') {
+                showSessionStatus((message.barcode ? message.barcode + ': ' : '') + message.error);
+            }
+        };
+        socket.onclose = function() {
+            if (scanSocket === socket) {
+                scanSocket = null;
+            }
+        };
+    }
+
+    function closeScanSession() {
+        if (scanSocket) {
+            scanSocket.close();
+            scanSocket = null;
+        }
+    }
+
+    cameraAllergiesInput.addEventListener('change', function() {
+        if (scanSocket && scanSocket.readyState === WebSocket.OPEN) {
+            sendSessionStart();
+        }
+    });
+
+    // Scanner configuration
+    function startScanner() {
+        const viewport = document.getElementById('interactive');
+        viewport.innerHTML = '';
+
+        // Create video element
+        const video = document.createElement('video');
+        video.setAttribute('playsinline', true);
+        video.setAttribute('autoplay', true);
+        video.style.width = '100%';
+        video.style.height = '100%';
+        viewport.appendChild(video);
+
+        // Add scanning feedback overlay
+        const feedback = document.createElement('div');
+        feedback.className = 'scanning-feedback';
+        const scanLine = document.createElement('div');
+        scanLine.className = 'scanning-line';
+        feedback.appendChild(scanLine);
+        viewport.appendChild(feedback);
+
+        let isProcessing = false;
+        let lastDetectedCode = null;
+        let lastDetectionTime = 0;
+        const detectionThreshold = 50; // Reduced to 50ms for faster response
+
+        // Initialize Quagga
+        function initQuagga(stream) {
+            Quagga.init({
+                inputStream: {
+                    name: "Live",
+                    type: "LiveStream",
+                    target: video,
+                    constraints: {
+                        width: 1280,
+                        height: 720,
+                        facingMode: "environment",
+                        aspectRatio: 1.777778,
+                        frameRate: 60
+                    },
+                    area: { // Tighter scan area for faster processing
+                        top: "35%",
+                        right: "15%",
+                        left: "15%",
+                        bottom: "35%",
+                    },
+                    singleChannel: true // Faster processing
+                },
+                decoder: {
+                    readers: ["ean_reader", "ean_8_reader", "upc_reader", "upc_e_reader"],
+                    multiple: false,
+                    debug: false,
+                    locate: true
+                },
+                locate: true,
+                frequency: 60, // Process every frame
+                numOfWorkers: 8, // Use more workers
+                locator: {
+                    patchSize: "medium",
+                    halfSample: false
+                }
+            }, function(err) {
+                if (err) {
+                    console.error('Quagga initialization failed:', err);
+                    return;
+                }
+                console.log('Quagga initialization succeeded');
+                Quagga.start();
+            });
+
+            // Handle successful scans
+            Quagga.onDetected(function(result) {
+                const currentTime = Date.now();
+                const code = result.codeResult.code;
+
+                // Only check time threshold for same code
+                if (isProcessing ||
+                    (code === lastDetectedCode &&
+                     currentTime - lastDetectionTime < detectionThreshold)) {
+                    return;
+                }
+
+                lastDetectedCode = code;
+                lastDetectionTime = currentTime;
+
+                // With a session open the camera keeps running and
+                // results arrive over the socket
+                if (scanSocket && scanSocket.readyState === WebSocket.OPEN) {
+                    console.log('Barcode detected:', code);
+                    showSessionStatus('Looking up ' + code + '...');
+                    scanSocket.send(JSON.stringify({ type: 'code', barcode: code }));
+                    return;
+                }
+
+                // Immediately stop scanning and show processing state
+                isProcessing = true;
+                Quagga.stop();
+                stopScanner();
+
+                // Show processing overlay
+                loadingOverlay.style.display = 'flex';
+                loadingOverlay.innerHTML = `
+                    <div class="text-center">
+                        <div class="spinner-border text-light mb-3" role="status">
+                            <span class="visually-hidden">Loading...</span>
+                        </div>
+                        <div class="text-light">
+                            <h4>Barcode Detected!</h4>
+                            <p>Processing product information...</p>
+                        </div>
+                    </div>
+                `;
+
+                console.log('Barcode detected:', code);
+
+                // Make API call
+                fetch('/scan_barcode', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({
+                        barcode: code,
+                        allergies: document.getElementById('cameraAllergiesInput').value.trim()
+                    })
+                })
+                .then(response => response.json())
+                .then(data => {
+                    if (data.success) {
+                        handleBarcodeSuccess(data);
+                    } else {
+                        loadingOverlay.style.display = 'none';
+                        alert('Error: ' + (data.error || 'Failed to process barcode'));
+                    }
+                })
+                .catch(error => {
+                    console.error('Error with API call:', error);
+                    loadingOverlay.style.display = 'none';
+                    alert('Error processing barcode. Please try again.');
+                });
+            });
+
+            // Minimal overlay drawing for performance
+            Quagga.onProcessed(function(result) {
+                if (result && result.codeResult && result.codeResult.code) {
+                    const drawingCtx = Quagga.canvas.ctx.overlay;
+                    const drawingCanvas = Quagga.canvas.dom.overlay;
+                    drawingCtx.clearRect(0, 0, parseInt(drawingCanvas.getAttribute("width")), parseInt(drawingCanvas.getAttribute("height")));
+                    if (result.box) {
+                        Quagga.ImageDebug.drawPath(result.box, { x: 0, y: 1 }, drawingCtx, { color: "#00F", lineWidth: 2 });
+                    }
+                }
+            });
+        }
+
+        // Try to start the camera
+        navigator.mediaDevices.getUserMedia({
+            video: {
+                facingMode: { ideal: 'environment' },
+                width: { ideal: 1280 },
+                height: { ideal: 720 }
+            }
+        })
+        .then(function(stream) {
+            video.srcObject = stream;
+            return video.play();
+        })
+        .then(() => {
+            initQuagga(video.srcObject);
+            openScanSession();
+            startButton.classList.add('d-none');
+            stopButton.classList.remove('d-none');
+            cameraPermissionAlert.style.display = 'none';
+        })
+        .catch(function(err) {
+            console.error('Camera error:', err);
+            displayCameraError(err);
+        });
+    }
+
+    // Improve stop scanner function
+    function stopScanner() {
+        Quagga.stop();
+        closeScanSession();
+        const video = document.querySelector('#interactive video');
+        if (video && video.srcObject) {
+            const tracks = video.srcObject.getTracks();
+            tracks.forEach(track => track.stop());
+            video.srcObject = null;
+        }
+        const viewport = document.getElementById('interactive');
+        viewport.innerHTML = '';
+        startButton.classList.remove('d-none');
+        stopButton.classList.add('d-none');
+    }
+
+    function displayCameraError(err) {
+        console.error('Camera error:', err);
+        let errorMessage = 'Camera access error: ';
+
+        if (err.name === 'NotAllowedError' || err.name === 'PermissionDeniedError') {
+            errorMessage = 'Please allow camera access in your browser settings.';
+        } else if (err.name === 'NotFoundError') {
+            errorMessage = 'No camera found. Please check your camera connection.';
+        } else if (err.name === 'NotReadableError') {
+            errorMessage = 'Cannot access camera. Please make sure no other app is using it.';
+        } else {
+            errorMessage = 'Error accessing camera. Please try again.';
+        }
+
+        cameraPermissionAlert.style.display = 'block';
+        cameraPermissionAlert.innerHTML = `
+            <i class="fas fa-exclamation-triangle me-2"></i>
+            <strong>Camera Access Error</strong><br>
+            ${errorMessage}<br><br>
+            <strong>Tips:</strong><br>
+            1. Make sure your camera is working<br>
+            2. Allow camera access if prompted<br>
+            3. Try refreshing the page<br>
+            4. You can also use the Manual Entry or Upload Images options
+        `;
+    }
+
+    function handleBarcodeSuccess(data) {
+        loadingOverlay.style.display = 'none';
+
+        // Show product info section
+        productInfo.style.display = 'block';
+
+        // Store the download URL
+        downloadUrl = data.pdf_url;
+        downloadButton.href = downloadUrl;
+
+        // Display product details
+        const product = data.product.product;
+        productTitle.textContent = product.product_name || 'Product Information';
+
+        // Display product image if available
+        if (product.image_url) {
+            productImage.src = product.image_url;
+            productImage.style.display = 'block';
+        } else {
+            productImage.style.display = 'none';
+        }
+
+        let detailsHTML = '<p><strong>Ingredients:</strong> ' + (product.ingredients_text || 'Not available') + '</p>';
+
+        // Display allergy analysis if available, or wait for it
+        pendingAnalysisId = null;
+        if (data.allergy_analysis) {
+            displayAllergyAnalysis(data.allergy_analysis);
+        } else if (data.analysis_url) {
+            showAnalysisPending(data.allergen_matches);
+            pollAnalysis(data.analysis_id, data.analysis_url);
+        } else {
+            allergyAnalysis.style.display = 'none';
+        }
+
+        productDetails.innerHTML = detailsHTML;
+
+        // Scroll to the product info
+        productInfo.scrollIntoView({ behavior: 'smooth' });
+    }
+
+    // The verdict for a scan arrives after the product card
+    let pendingAnalysisId = null;
+
+    function showAnalysisPending(allergenMatches) {
+        allergyAnalysis.style.display = 'block';
+        let html = '<div class="d-flex align-items-center">' +
+            '<div class="spinner-border spinner-border-sm me-2" role="status"></div>' +
+            '<span>Analyzing ingredients for your allergies...</span></div>';
+        if (allergenMatches && allergenMatches.length) {
+            html += '<div class="alert alert-warning mt-3 mb-0">Ingredients mention: ' +
+                allergenMatches.join(', ') + '</div>';
+        }
+        allergyAnalysis.innerHTML = html;
+    }
+
+    function pollAnalysis(analysisId, analysisUrl) {
+        pendingAnalysisId = analysisId;
+        fetch(analysisUrl)
+        .then(response => response.json())
+        .then(job => {
+            // A newer scan has replaced this one
+            if (pendingAnalysisId !== analysisId) {
+                return;
+            }
+            if (job.status === 'pending') {
+                setTimeout(() => pollAnalysis(analysisId, analysisUrl), 1000);
+            } else if (job.status === 'done') {
+                pendingAnalysisId = null;
+                displayAllergyAnalysis(job.allergy_analysis);
+                downloadButton.href = job.pdf_url;
+            } else {
+                pendingAnalysisId = null;
+                allergyAnalysis.innerHTML = '<div class="alert alert-danger mb-0">' +
+                    (job.error || 'Allergy analysis failed') + '</div>';
+            }
+        })
+        .catch(error => {
+            console.error('Error fetching analysis:', error);
+            if (pendingAnalysisId === analysisId) {
+                setTimeout(() => pollAnalysis(analysisId, analysisUrl), 2000);
+            }
+        });
+    }
+
+    // Start scanner button click handler
+    startButton.addEventListener('click', startScanner);
+
+    // Stop scanner button click handler
+    stopButton.addEventListener('click', stopScanner);
+
+    // Manual barcode submission
+    manualSubmit.addEventListener('click', function() {
+        const barcode = barcodeInput.value.trim();
+        const allergies = allergiesInput.value.trim();
+
+        if (!barcode) {
+            alert('Please enter a valid barcode');
+            return;
+        }
+
+        loadingOverlay.style.display = 'flex';
+
+        // Make direct API call
+        fetch('/scan_barcode', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                barcode: barcode,
+                allergies: allergies
+            })
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (data.error) {
+                throw new Error(data.error);
+            }
+            handleBarcodeSuccess(data);
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            loadingOverlay.style.display = 'none';
+            alert('Failed to process barcode: ' + error.message);
+        });
+    });
+
+    // Add new JavaScript for handling uploads
+    const uploadBarcodeBtn = document.getElementById('uploadBarcodeBtn');
+    const uploadIngredientsBtn = document.getElementById('uploadIngredientsBtn');
+    const barcodeImageInput = document.getElementById('barcodeImageInput');
+    const ingredientsImageInput = document.getElementById('ingredientsImageInput');
+    const uploadAllergiesInput = document.getElementById('uploadAllergiesInput');
+
+    uploadBarcodeBtn.addEventListener('click', function() {
+        const file = barcodeImageInput.files[0];
+        const allergies = uploadAllergiesInput.value.trim();
+
+        if (!file) {
+            alert('Please select a barcode image');
+            return;
+        }
+
+        const formData = new FormData();
+        formData.append('barcode_image', file);
+        formData.append('allergies', allergies);
+
+        loadingOverlay.style.display = 'flex';
+
+        fetch('/upload_barcode', {
+            method: 'POST',
+            body: formData
+        })
+        .then(response => response.json())
+        .then(data => handleResponse(data))
+        .catch(handleError);
+    });
+
+    uploadIngredientsBtn.addEventListener('click', function() {
+        const file = ingredientsImageInput.files[0];
+        const allergies = uploadAllergiesInput.value.trim();
+
+        if (!file) {
+            alert('Please select an ingredients image');
+            return;
+        }
+
+        const formData = new FormData();
+        formData.append('ingredients_image', file);
+        formData.append('allergies', allergies);
+
+        loadingOverlay.style.display = 'flex';
+
+        fetch('/upload_ingredients', {
+            method: 'POST',
+            body: formData
+        })
+        .then(response => response.json())
+        .then(data => handleResponse(data))
+        .catch(handleError);
+    });
+
+    function handleResponse(data) {
+        loadingOverlay.style.display = 'none';
+
+        if (data.error) {
+            alert('Error: ' + data.error);
+            return;
+        }
+
+        // Show product info section
+        productInfo.style.display = 'block';
+
+        if (data.product) {
+            const product = data.product.product;
+            productTitle.textContent = product.product_name || 'Product Information';
+
+            if (product.image_url) {
+                productImage.src = product.image_url;
+                productImage.style.display = 'block';
+            } else {
+                productImage.style.display = 'none';
+            }
+
+            let detailsHTML = '<p><strong>Ingredients:</strong> ' + (product.ingredients_text || 'Not available') + '</p>';
+            productDetails.innerHTML = detailsHTML;
+        } else {
+            productTitle.textContent = 'Ingredients Analysis';
+            productImage.style.display = 'none';
+            let detailsHTML = '<p><strong>Extracted Ingredients:</strong> ' + data.ingredients + '</p>';
+            productDetails.innerHTML = detailsHTML;
+        }
+
+        // Display allergy analysis
+        if (data.allergy_analysis) {
+            displayAllergyAnalysis(data.allergy_analysis);
+        }
+
+        // Update download button
+        downloadButton.href = data.pdf_url;
+
+        // Scroll to results
+        productInfo.scrollIntoView({ behavior: 'smooth' });
+    }
+
+    function handleError(error) {
+        console.error('Error:', error);
+        loadingOverlay.style.display = 'none';
+        alert('An error occurred. Please try again.');
+    }
+
+    function displayAllergyAnalysis(analysis) {
+        allergyAnalysis.style.display = 'block';
+
+        // Extract safety rating and status
+        const ratingMatch = analysis.match(/SAFETY RATING:\s*(\d+)/i);
+        const statusMatch = analysis.match(/SAFETY STATUS:\s*(SAFE|UNSAFE|CAUTION)/i);
+        const conclusionMatch = analysis.match(/CONCLUSION:\s*(SAFE|UNSAFE|CAUTION)\s*-\s*(.*)/i);
+
+        let formattedAnalysis = analysis;
+
+        // Add prominent safety rating and status at the top
+        if (ratingMatch) {
+            const rating = parseInt(ratingMatch[1]);
+            let statusColor, statusText, statusBoxColor;
+
+            if (rating <= 3) {
+                statusColor = 'danger';
+                statusText = 'Extremely Dangerous';
+                statusBoxColor = '#dc3545'; // Red
+            } else if (rating <= 5) {
+                statusColor = 'warning';
+                statusText = 'High Risk';
+                statusBoxColor = '#fd7e14'; // Orange
+            } else if (rating <= 7) {
+                statusColor = 'info';
+                statusText = 'Moderate Risk';
+                statusBoxColor = '#ffc107'; // Yellow
+            } else if (rating <= 9) {
+                statusColor = 'success';
+                statusText = 'Safe';
+                statusBoxColor = '#28a745'; // Light Green
+            } else {
+                statusColor = 'success';
+                statusText = 'Very Safe';
+                statusBoxColor = '#20c997'; // Green
+            }
+
+            formattedAnalysis = `
+                <div class="safety-rating-box" style="
+                    background-color: ${statusBoxColor};
+                    color: white;
+                    padding: 20px;
+                    border-radius: 10px;
+                    margin-bottom: 20px;
+                    box-shadow: 0 4px 6px rgba(0,0,0,0.1);
+                ">
+                    <div class="d-flex justify-content-between align-items-center">
+                        <div>
+                            <h3 class="mb-2" style="margin: 0;">Safety Rating: ${rating}/10</h3>
+                            <h4 class="mb-0" style="margin: 0;">${statusText}</h4>
+                        </div>
+                        <div class="text-end">
+                            <div class="progress" style="width: 120px; height: 25px; background-color: rgba(255,255,255,0.3);">
+                                <div class="progress-bar bg-white" role="progressbar"
+                                     style="width: ${rating * 10}%"
+                                     aria-valuenow="${rating}"
+                                     aria-valuemin="0"
+                                     aria-valuemax="10">
+                                    ${rating}/10
+                                </div>
+                            </div>
+                        </div>
+                    </div>
+                </div>
+                ${formattedAnalysis}
+            `;
+        }
+
+        // Format the analysis text
+        formattedAnalysis = formattedAnalysis.replace(/\n/g, '<br>');
+
+        // Add highlighted conclusion if available
+        if (conclusionMatch) {
+            const status = conclusionMatch[1].toUpperCase();
+            const explanation = conclusionMatch[2];
+            const statusColor = status === 'SAFE' ? 'success' :
+                              status === 'UNSAFE' ? 'danger' : 'warning';
+            formattedAnalysis += `
+                <div class="alert alert-${statusColor} mt-3">
+                    <strong>Final Decision:</strong> ${status}<br>
+                    ${explanation}
+                </div>
+            `;
+        }
+
+        allergyAnalysis.innerHTML = formattedAnalysis;
+    }
+});